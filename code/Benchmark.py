@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the stages of the FlowRaster pipeline
+
+Runs readRaster, resample, FlowRaster construction, setDownnodes,
+addRainfall, flow extraction, calculateLakes and getMaximumFlow one after
+the other, on a ladder of seeded random terrains and on dem_hack.txt, and
+reports wall time, peak memory and cells per second of every stage as JSON.
+
+Every pipeline runs twice, once timed and once with tracemalloc for the
+peak memory, as tracing slows down the stages that create many objects.
+
+Usage:
+    python Benchmark.py [--sizes 64 128 256] [--factor 2] [--classes array object]
+                        [--engine path] [--seed 0] [--no-dem] [--no-memory] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import Flow
+from RasterHandler import readRaster, writeRaster, createRanRasterSlope
+
+SIZES=(64, 128, 256)
+DEM='ascifiles/dem_hack.txt'
+RASTER_CLASSES={"array": Flow.ArrayFlowRaster, "object": Flow.FlowRaster}
+
+
+def runPipeline(fileName, factor=2, rasterClass=Flow.ArrayFlowRaster, engine="path", seed=0, traced=False):
+    """Runs the pipeline stages on one ascii raster
+
+    Input Parameter:
+        fileName – path of the ascii raster with the elevation
+        factor – resample factor
+        rasterClass – FlowRaster or ArrayFlowRaster
+        engine – lake engine passed to calculateLakes
+        seed – seed of the random rainfall
+        traced – if True, the peak memory of every stage is measured with tracemalloc
+
+    Returns:
+        a tuple (shape, stages)
+            shape: (rows, cols) of the flow raster
+            stages: a dictionary by stage name with seconds, cells and, if traced, peakBytes
+    """
+    stages={}
+
+    def measure(name, cells, function):
+        if traced:
+            tracemalloc.start()
+        start=time.perf_counter()
+        result=function()
+        seconds=time.perf_counter()-start
+        stages[name]={"seconds": seconds, "cells": cells}
+        if traced:
+            stages[name]["peakBytes"]=tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+
+    raster=measure("readRaster", None, lambda: readRaster(fileName, cache=False))
+    stages["readRaster"]["cells"]=raster.getData().size
+    resampled=measure("resample", raster.getData().size, lambda: raster.resample(factor))
+    rows,cols=resampled.getShape()
+    rain=createRanRasterSlope(rows, cols, datahi=10., datalo=0., seed=seed+1).getData() #not part of any stage
+
+    flowraster=measure("construct", rows*cols, lambda: rasterClass(resampled))
+    measure("setDownnodes", rows*cols, flowraster.setDownnodes)
+    measure("addRainfall", rows*cols, lambda: flowraster.addRainfall(rain))
+    measure("extractFlow", rows*cols, lambda: flowraster.extractValues(Flow.FlowExtractor()))
+    measure("calculateLakes", rows*cols, lambda: flowraster.calculateLakes(engine))
+    measure("getMaximumFlow", rows*cols, flowraster.getMaximumFlow)
+    return (rows, cols), stages
+
+
+def benchmark(inputs, factor=2, classes=("array", "object"), engine="path", seed=0, memory=True):
+    """Benchmarks the pipeline on several rasters and raster classes
+
+    Input Parameter:
+        inputs – list of (name, fileName) tuples of ascii rasters
+        factor – resample factor
+        classes – names of the raster classes, keys of RASTER_CLASSES
+        engine – lake engine passed to calculateLakes
+        seed – seed of the random rainfall
+        memory – if True, every pipeline is run a second time to measure the peak memory
+
+    Returns:
+        a list with one dictionary per raster and class, see the JSON output
+    """
+    runs=[]
+    for name, fileName in inputs:
+        for className in classes:
+            shape,stages=runPipeline(fileName, factor, RASTER_CLASSES[className], engine, seed)
+            if memory:
+                traced=runPipeline(fileName, factor, RASTER_CLASSES[className], engine, seed, traced=True)[1]
+            for stage, result in stages.items():
+                result["cellsPerSecond"]=result["cells"]/result["seconds"] if result["seconds"]>0 else None
+                result["peakBytes"]=traced[stage]["peakBytes"] if memory else None
+            runs.append({"input": name, "class": RASTER_CLASSES[className].__name__,
+                         "rows": shape[0], "cols": shape[1], "stages": stages})
+            print("{:<24} {:<16} {:>8.3f} s".format(name, RASTER_CLASSES[className].__name__,
+                  sum(result["seconds"] for result in stages.values())), file=sys.stderr)
+    return runs
+
+
+def main(argv=None):
+    """Runs the benchmark from the command line and writes the JSON report"""
+    parser=argparse.ArgumentParser(description="Benchmark of the stages of the FlowRaster pipeline")
+    parser.add_argument("--sizes", type=int, nargs="*", default=list(SIZES),
+                        help="side lengths of the random flow rasters, the terrains are factor times larger")
+    parser.add_argument("--factor", type=int, default=2, help="resample factor")
+    parser.add_argument("--classes", nargs="+", default=["array", "object"], choices=sorted(RASTER_CLASSES))
+    parser.add_argument("--engine", default="path", choices=["path", "priorityflood"], help="lake engine")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random terrains and rainfall")
+    parser.add_argument("--no-dem", action="store_true", help="skip {}".format(DEM))
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run for the peak memory")
+    parser.add_argument("--output", help="file for the JSON report, standard output if left out")
+    args=parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        inputs=[]
+        for size in args.sizes:
+            fileName=os.path.join(directory, "slope{}.asc".format(size))
+            terrain=createRanRasterSlope(size*args.factor, size*args.factor, ranpart=0.1, seed=args.seed)
+            writeRaster(fileName, terrain)
+            inputs.append(("slope{}-seed{}".format(size, args.seed), fileName))
+        if not args.no_dem:
+            inputs.append((os.path.basename(DEM), os.path.join(os.path.dirname(os.path.abspath(__file__)), DEM)))
+        runs=benchmark(inputs, args.factor, args.classes, args.engine, args.seed, not args.no_memory)
+
+    report={"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "factor": args.factor, "engine": args.engine, "seed": args.seed, "runs": runs}
+    if args.output:
+        with open(args.output, 'w') as myFile:
+            json.dump(report, myFile, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__=="__main__":
+    main()
@@ -155,5 +155,5 @@ calculateFlowsAndPlot(elevationRasterA, rainrasterA, resampleFactorA)
 
 ############# step 5 #######################################
 
-#calculateFlowsAndPlot(readRaster('ascifiles/dem_hack.txt'), readRaster('ascifiles/rain_small_hack.txt'), 10)
+#calculateFlowsAndPlot(readRaster('ascifiles/dem_hack.txt', cache=True), readRaster('ascifiles/rain_small_hack.txt', cache=True), 10)
 
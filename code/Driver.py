@@ -1,28 +1,41 @@
 from RasterHandler import createRanRasterSlope
 import matplotlib.pyplot as mp
+import numpy as np
 import Flow as Flow
 from RasterHandler import readRaster
+from FlowEngine import basinLabels
 
 
 """This is the driver - Livia Jakob S1790173"""
 
 
 
-def plotstreams(flownode,colour):
-    """Recursively plots upnodes in given colour
+def plotstreams(flowRaster, cells, downnodes, colour):
+    """Plots the streams from cells to their downnodes in given colour
+    
+    All segments go into one plot call
     
     Input Parameter:
-        flownode – a FlowNode object
+        flowRaster – a FlowRaster object
+        cells – int array with flat indices (row*cols+col) of cells with a downnode
+        downnodes – flat downnode array of the raster (see FlowRaster.getDownnodes)
         colour – a colour, e.g. "red"
     """
-    for node in flownode.getUpnodes():
-        x1=flownode.get_x()
-        y1=flownode.get_y()
-        x2=node.get_x()
-        y2=node.get_y()
-        mp.plot([x1,x2],[y1,y2],color=colour)
-        if (node.numUpnodes()>0):
-            plotstreams(node,colour)
+    x1,y1=cellCoordinates(flowRaster, downnodes[cells])
+    x2,y2=cellCoordinates(flowRaster, cells)
+    gap=np.full(cells.size, np.nan) #separates the segments
+    mp.plot(np.column_stack((x1,x2,gap)).ravel(), np.column_stack((y1,y2,gap)).ravel(), color=colour)
+
+def cellCoordinates(flowRaster, cells):
+    """Returns the x and y coordinates of cells, like FlowNode.get_x() and get_y()
+    
+    Input Parameter:
+        flowRaster – a FlowRaster object
+        cells – int array with flat indices
+    """
+    rows,cols=np.divmod(cells, flowRaster.getCols())
+    return (cols*flowRaster.getCellsize()+flowRaster.getOrgs()[1], 
+            rows*flowRaster.getCellsize()+flowRaster.getOrgs()[0])
 
 def plotFlowNetwork(originalRaster, flowRaster, title="", plotLakes=True):
     """Plots a flow network
@@ -38,20 +51,23 @@ def plotFlowNetwork(originalRaster, flowRaster, title="", plotLakes=True):
     print ("\n\n{}".format(title))
     mp.imshow(originalRaster.extractValues(Flow.ElevationExtractor()))
     mp.colorbar()
-    colouri=-1
     colours=["black","red","magenta","yellow","green","cyan","white","orange","grey","brown"]
 
-    for i in range(flowRaster.getRows()):
-        for j in range(flowRaster.getCols()):
-            node = flowRaster._data[i,j]
-            
-            if (node.getPitFlag()): # dealing with a pit
-                mp.scatter(node.get_x(),node.get_y(), color="red")
-                colouri+=1
-                plotstreams(node, colours[colouri%len(colours)])
-                
-            if (plotLakes and node.getLakeDepth() > 0): #if lakedepth is zero, it is not a lake
-                mp.scatter(node.get_x(),node.get_y(), color="blue")
+    downnodes=flowRaster.getDownnodes() #cached with the network
+    pitflags=np.flatnonzero(downnodes<0) # dealing with pits
+    x,y=cellCoordinates(flowRaster, pitflags)
+    mp.scatter(x,y, color="red")
+    #every basin in the colour of its pit, one plot call per colour
+    pitColour=np.zeros(downnodes.size, dtype=np.int64)
+    pitColour[pitflags]=np.arange(pitflags.size)%len(colours)
+    cellColour=pitColour[basinLabels(downnodes)]
+    for colouri, colour in enumerate(colours):
+        plotstreams(flowRaster, np.flatnonzero((cellColour==colouri) & (downnodes>=0)), downnodes, colour)
+        
+    if plotLakes:
+        lakes=np.flatnonzero(flowRaster.extractValues(Flow.LakeDepthExtractor())>0) #if lakedepth is zero, it is not a lake
+        x,y=cellCoordinates(flowRaster, lakes)
+        mp.scatter(x,y, color="blue")
 
     mp.show()
 
@@ -126,12 +142,13 @@ def calculateFlowsAndPlot(elevation, rain, resampleF):
     
     #TESTING
     #this line tests if total raster outflow is equal to total rainfall on the raster
-    assert round(fr.getTotalFlow(), 2) == round(fr.getTotalRainfall(),2)
+    statistics=fr.getFlowStatistics() #all from the cached flow grid
+    assert round(statistics["totalOutflow"], 2) == round(statistics["totalRainfall"],2)
     
     
     ############# step 5 #######################################
-    maxflow=fr.getMaximumFlow()
-    print("Task 5: Maximum Flow: {} mm, at FlowNode object: {}".format(round(maxflow[0], 3), maxflow[1]))
+    maxnode=fr.getNode(*statistics["maxcell"])
+    print("Task 5: Maximum Flow: {} mm, at FlowNode object: {}".format(round(statistics["maxflow"], 3), maxnode))
 
     
 
@@ -159,5 +176,5 @@ calculateFlowsAndPlot(elevationRasterA, rainrasterA, resampleFactorA)
 
 ############# step 5 #######################################
 
-#calculateFlowsAndPlot(readRaster('ascifiles/dem_hack.txt'), readRaster('ascifiles/rain_small_hack.txt'), 10)
+#calculateFlowsAndPlot(readRaster('ascifiles/dem_hack.txt', cache=True), readRaster('ascifiles/rain_small_hack.txt', cache=True), 10)
 
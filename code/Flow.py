@@ -1,31 +1,73 @@
+import heapq
+import os
+
 import numpy as np
 
 from Points import Point2D
 from Raster import Raster
+from ParallelFlow import parallelAccumulateFlow
+from FlowEngine import d8Downnodes, topologicalLevels, accumulateFlow, priorityFlood, floodDownnodes, lakeOutflows, groupLakes, drainLake
+from FlowEngine import neighbourCells, d8Cells, upstreamCells, downstreamCells, connectedCells, reaccumulateFlow
+from FlowEngine import upstreamGraph, catchmentCells, basinLabels
+from Profiling import FlowProfile, instrumentRaster, uninstrument
 
 class FlowNode(Point2D):
     """Class representing nodes (points) in a Flow Raster
     
+    The node keeps its coordinates in the x and y slots of Point2D and its 
+    integer row and column in slots of its own. All attributes are slots and 
+    a list of upnodes is only created for nodes with more than one upnode, 
+    which keeps the object graph of large rasters small.
+    
     Inherits from Point2D class
     
     """
     
-    def __init__(self,x,y, value, rainfall=None):
+    __slots__=("_row","_col","_downnode","_upnodes","_value","_rainfall","_lakedepth","_raster")
+    
+    def __init__(self,x,y, value, rainfall=None, raster=None, row=None, col=None):
         """Constructor for FlowNode
         
         Input Parameter:
-            x – x-position of node within grid
-            y – y-position of node within grid
+            x – x-coordinate of the node
+            y – y-coordinate of the node
             value – value at the node position (e.g. elevation)
+            rainfall – rain at the node in mm
+            raster – FlowRaster the node belongs to, told about changes of flow inputs
+            row, col – position of the node within the grid (int), 
+                       calculated from the coordinates if left out
         
         """
-        Point2D.__init__(self,x,y) #use constructor of super class
-        self._downnode=None #is set with setDownnode()
-        self._upnodes=[]
-        self._pitflag=True #set to true as FlowNode doesn't have a downnode at the moment
+        self._x=float(x) #float() keeps float objects, so nodes can share them
+        self._y=float(y)
+        if row is None or col is None:
+            cellsize,orgs=(raster.getCellsize(), raster.getOrgs()) if raster is not None else (1., (0., 0.))
+            row=int(round((self._y-orgs[0])/cellsize))
+            col=int(round((self._x-orgs[1])/cellsize))
+        self._row=row
+        self._col=col
+        self._downnode=None #is set with setDownnode(), pitflag as long as it is None
+        self._upnodes=None #None, a single upnode or a list of upnodes
         self._value=value
         self._rainfall=rainfall
         self._lakedepth=0
+        self._raster=raster
+        
+        
+    def getRow(self):
+        """Returns the row of the node within the grid (int)"""
+        return self._row
+    
+    
+    def getCol(self):
+        """Returns the column of the node within the grid (int)"""
+        return self._col
+    
+    
+    def clone(self):
+        """returns a Point2D at the coordinates of the node"""
+        return Point2D(self._x, self._y)
+    
         
     def setDownnode(self, newDownNode):
         """Sets the downnode of a FlowNode object, sets itself as an upnode 
@@ -35,7 +77,8 @@ class FlowNode(Point2D):
             newDownNode – a FlowNode object representing the downnode
             
         """
-        self._pitflag=(newDownNode==None) #sets pitflag to True if downnode exists, else to false
+        if newDownNode is not self._downnode and self._raster is not None:
+            self._raster._invalidateFlows() #network changes, cached flows are outdated
         
         if (self._downnode!=None): # change previous
             self._downnode._removeUpnode(self) #remove itself as upnode (from thre downnode)
@@ -60,6 +103,8 @@ class FlowNode(Point2D):
         Input Parameter:
             rainfall – rain at FlowNode object in mm
         """
+        if rainfall is not self._rainfall and rainfall != self._rainfall and self._raster is not None:
+            self._raster._invalidateFlows(rainfallOnly=True) #cached flows from rainfall per node are outdated
         self._rainfall = rainfall
         
         
@@ -75,8 +120,12 @@ class FlowNode(Point2D):
     def getUpnodes(self):
         """Getter for self._upnodes
         Returns:
-           self._upnodes – a list of FlowNode class objects
+           self._upnodes – a list of FlowNode class objects (empty if there are none)
         """
+        if self._upnodes is None:
+            return []
+        if isinstance(self._upnodes, FlowNode):
+            return [self._upnodes]
         return self._upnodes
     
     
@@ -86,16 +135,28 @@ class FlowNode(Point2D):
         Input Parameter:
             nodeToRemove – a FlowNode object
         """
+        if self._upnodes is nodeToRemove:
+            self._upnodes=None
+            return
         self._upnodes.remove(nodeToRemove)
+        if len(self._upnodes)==1:
+            self._upnodes=self._upnodes[0] #back to a single upnode
     
     
     def _addUpnode(self, nodeToAdd):
         """Adds an upnode
         
+        A single upnode is stored directly, the list is only created for the second one
+        
         Input Parameter:
             nodeToAdd – a FlowNode object
         """
-        self._upnodes.append(nodeToAdd)
+        if self._upnodes is None:
+            self._upnodes=nodeToAdd
+        elif isinstance(self._upnodes, FlowNode):
+            self._upnodes=[self._upnodes, nodeToAdd]
+        else:
+            self._upnodes.append(nodeToAdd)
 
 
     def numUpnodes(self):
@@ -103,17 +164,21 @@ class FlowNode(Point2D):
         Returns:
            number of Upnodes
         """
+        if self._upnodes is None:
+            return 0
+        if isinstance(self._upnodes, FlowNode):
+            return 1
         return len(self._upnodes)
     
     
     def getPitFlag(self):
-        """Getter for self._pitflag
+        """Returns whether the node is a pitflag
         Returns:
-           self._pitflag – True or False: 
+           True or False: 
                            True when it is a pitFlag(=no downnodes)
                            False when it is not (=has downnodes)
         """
-        return self._pitflag
+        return self._downnode is None
     
     
     def setLakeDepth(self, depth):
@@ -135,22 +200,27 @@ class FlowNode(Point2D):
     
     
     def getFlow(self, constRain=None):
-        """recursively adds the flow of all upnodes and its upnodes etc.
+        """adds up the flow of all upnodes and its upnodes etc.
         If constant rain input parameter is null, flow is calculated from 
         recorded rainfall per node using self._rainfall
         If both, constant and self._rainfall are None, it calculates with 0mm rain
         
+        Upnodes are visited with an explicit stack instead of recursion, so 
+        long rivers don't hit the recursion limit. To get the flow of every 
+        node use FlowRaster.getFlowGrid() instead.
+        
         Input Parameter:
             constRain – constant rain per node in mm, if left out the rainfall per node value is used
         """
         flow=0 #set to zero
-        if constRain is not None:
-            flow=constRain #initial flow is set to constant rain
-        elif self.getRainfall() is not None: #if no constant rain is given it checks if a rainfall at this node is recorded
-            flow=self.getRainfall() #initial flow is set to rainfall on cell
-        
-        for upnode in self.getUpnodes(): #iterare through upnotes
-            flow+=upnode.getFlow(constRain) #add up flow by calling the function recursively with next upnode
+        tovisit=[self]
+        while tovisit:
+            node=tovisit.pop()
+            if constRain is not None:
+                flow+=constRain #add constant rain
+            elif node.getRainfall() is not None: #if no constant rain is given it checks if a rainfall at this node is recorded
+                flow+=node.getRainfall() #add rainfall on cell
+            tovisit.extend(node.getUpnodes()) #visit upnodes later
         
         return flow #return result
         
@@ -205,23 +275,27 @@ class FlowRaster(Raster):
     Inherits from Raster
     """
 
-    def __init__(self,araster):
+    def __init__(self,araster, profile=False):
         """Constructor for FlowRaster
         
         Input Parameter:
             araster – a Raster class object
+            profile – if True, profiling is enabled before the downnodes are calculated (see enableProfiling)
         
         """
         #create a new raster out of araster without data
         super().__init__(None,araster.getOrgs()[0],araster.getOrgs()[1],araster.getCellsize())#call init of raster class
+        self._resetFlowCache()
         data = araster.getData() #get elevation of input raster
         nodes=[]
+        #nodes in the same row or column share the int and float objects
+        columns=list(range(data.shape[1]))
+        xs=[float(j*self.getCellsize()+self.getOrgs()[1]) for j in columns] #x-position of the nodes within grid
         #insert data
-        for i in range(data.shape[0]):
-            for j in range(data.shape[1]):
-                y=(i)*self.getCellsize()+self.getOrgs()[0] #x-position of node within grid
-                x=(j)*self.getCellsize()+self.getOrgs()[1] #y-position of node within grid
-                nodes.append(FlowNode(x,y, data[i,j]))#add node
+        for i, values in enumerate(data.tolist()):
+            y=float(i*self.getCellsize()+self.getOrgs()[0]) #y-position of the nodes within grid
+            for j, x, value in zip(columns, xs, values):
+                nodes.append(FlowNode(x,y, value, raster=self, row=i, col=j))#add node
             
         nodearray=np.array(nodes) #convert list to array
         nodearray.shape=data.shape #reshape 1d array to shape of the raster
@@ -229,10 +303,26 @@ class FlowRaster(Raster):
 
         self.__neighbourIterator=np.array([1,-1,1,0,1,1,0,-1,0,1,-1,-1,-1,0,-1,1] ) #neighbours
         self.__neighbourIterator.shape=(8,2)        
+        self._profile=None
+        if profile:
+            self.enableProfiling()
         self.setDownnodes() #calculate downnodes
         self._lakes=[]
       
         
+    def getNode(self, r, c):
+        """Returns the node at row r and column c
+        
+        Input Parameter:
+            r – row of the cell (int)
+            c – column of the cell (int)
+        
+        Returns:
+            a FlowNode object
+        """
+        return self._data[r,c]
+    
+    
     def getPitflags(self):
         """Returns a list of pitflag nodes
         Pitflags are nodes without a downnode
@@ -248,7 +338,7 @@ class FlowRaster(Raster):
         return pitflags
     
 
-    def calculateLakes(self):
+    def calculateLakes(self, engine="path"):
         """Calculates lakes and creates Lake class objects
         
         Calculates lakes from pitflags, calculates depth for each lake node, 
@@ -258,9 +348,19 @@ class FlowRaster(Raster):
         
         The lakes are stored in self._lakes, a list with Lake objects
         
+        Input Parameter:
+            engine – "path" (default) grows a lake from every pitflag as described above, 
+                     "priorityflood" fills all depressions in one pass (see fillDepressions)
+        
         """        
+        if engine=="priorityflood":
+            self.fillDepressions()
+            return
+        elif engine!="path":
+            raise ValueError("unknown lake engine: {}".format(engine))
+        
         for pitflag in self.getPitflags(): #iterate through pitflags
-            i,j = int(pitflag.get_y()/self.getCellsize()), int(pitflag.get_x()/self.getCellsize())
+            i,j = pitflag.getRow(), pitflag.getCol()
             edgecase = i==0 or j==0 or i==(self._data.shape[0]-1) or j==(self._data.shape[1]-1)
             #check again if pitflag because it might have changed when two lakes grow together
             if pitflag.getPitFlag() and not(edgecase):
@@ -268,8 +368,75 @@ class FlowRaster(Raster):
         
         for lake in self._lakes:
             self.setLakeDownnodes(lake) #set new downnodes
-            assert not(lake._outflow.getPitFlag())
             assert not(lake._nodes[-2].getPitFlag())
+        enclosed=self._fillEnclosedOutflows()
+        for lake in self._lakes:
+            assert not(lake._outflow.getPitFlag()) or self._isEdgeNode(lake._outflow) #edge outflows of flats drain off the raster
+        self._lakes.extend(enclosed)
+        self._invalidateFlows()
+        
+        
+    def _fillEnclosedOutflows(self):
+        """Fills the depressions around lake outflows that were left without an exit
+        
+        On flats two lakes can spill into each other, so every neighbour of an 
+        outflow drains back to it and it stays a pitflag inside the raster. The 
+        cells draining to such pitflags are filled and routed with the priority 
+        flood (see fillDepressions), all other cells keep their downnodes.
+        
+        Returns:
+            the filled depressions, a list of FilledLake objects
+        """
+        nodes=self._data.ravel()
+        downnodes=self._getDownnodeArray()
+        pitflags=downnodes<0
+        enclosed=np.flatnonzero(pitflags & ~self._edgeMask().ravel())
+        if enclosed.size==0:
+            return []
+        elevation=self._getElevationArray()
+        cells=np.flatnonzero(np.isin(basinLabels(downnodes), enclosed))
+        filled,parents=priorityFlood(elevation.reshape(self.getShape()), pitflags.reshape(self.getShape()) & self._edgeMask())
+        flooded=floodDownnodes(filled, parents)[0].ravel()
+        filled=filled.ravel()
+        depth=np.zeros(nodes.size)
+        depth[cells]=filled[cells]-elevation[cells]
+        for index in cells[depth[cells]>0]:
+            nodes[index].fill(filled[index]) #fill lake nodes up to the lake surface
+        downnodes[cells]=flooded[cells]
+        for index in cells:
+            nodes[index].setDownnode(None if downnodes[index]<0 else nodes[downnodes[index]])
+        return [FilledLake(nodes[lake], nodes[outflow]) for lake, outflow in groupLakes(lakeOutflows(depth, downnodes))]
+        
+        
+    def fillDepressions(self):
+        """Fills all depressions at once with a priority flood from the raster edge
+        
+        The flood starts at the edge pitflags, the cells water leaves the raster 
+        through. The lake nodes are filled up to the lake surface (which sets their 
+        lake depth), cells with a lower neighbour on the filled surface drain to it 
+        and cells on a lake surface drain towards the outflow (see FlowEngine.priorityFlood).
+        Only edge cells can stay pitflags.
+        
+        The lakes are stored in self._lakes as FilledLake objects
+        """
+        nodes=self._data.ravel()
+        elevation=self._getElevationArray()
+        pitflags=np.fromiter((node.getPitFlag() for node in nodes), dtype=bool, count=nodes.size)
+        filled,parents=priorityFlood(elevation.reshape(self.getShape()), pitflags.reshape(self.getShape()) & self._edgeMask())
+        downnodes,pitflags=floodDownnodes(filled, parents)
+        filled=filled.ravel()
+        downnodes=downnodes.ravel()
+        
+        for index in np.flatnonzero(filled>elevation):
+            nodes[index].fill(filled[index]) #fill lake nodes up to the lake surface
+        for index in range(nodes.size):
+            down=None if downnodes[index]<0 else nodes[downnodes[index]]
+            if nodes[index].getDownnode() is not down:
+                nodes[index].setDownnode(down)
+                
+        for cells, outflow in groupLakes(lakeOutflows(filled-elevation, downnodes)):
+            self._lakes.append(FilledLake(nodes[cells], nodes[outflow]))
+        self._invalidateFlows()
             
                         
             
@@ -293,13 +460,15 @@ class FlowRaster(Raster):
         
         while(lake._outflow is None): #while lake has no outflow
             lowest=lake.lowestNeighbour()
-            r,c=int(lowest.get_y()/self.getCellsize()), int(lowest.get_x()/self.getCellsize()) #row and col
+            r,c=lowest.getRow(), lowest.getCol() #row and col
             lake.addNode(lowest) #adds a new node to the lake, this also removes the node from neighbours
             lake.addNeighbours(self.getNeighbours(r,c)) #add new neighbours
             
             edgecase = r==0 or c==0 or r==(self._data.shape[0]-1) or c==(self._data.shape[1]-1)
             
             if lowest.getPitFlag() and edgecase: #yeah we arrived at an edge pitfall, no more searching is needed 
+                if self._profile is not None:
+                    self._profile.addLake(len(lake._nodes), lake._order) #before the lake is cut back to its outflow
                 lake.finalise() # finalise the lake
         return lake
     
@@ -310,36 +479,48 @@ class FlowRaster(Raster):
         """Recalculates the downnodes for each lake node using a gravitation algorithm 
         towards the outflow. Recalculates the outflow downnode.
         
+        The lake cells are drained in order of their distance to the outflow 
+        with FlowEngine.drainLake, which works on flat cell indices
+        
         Input Parameter:
             lake – a Lake object
         """
-        checked=[] #stores checked nodes
-        checknode=lake._outflow #stores the current node to be checked
-        tocheck=[lake._outflow] #stores the future nodes to be checked
-
-        while (len(tocheck)+len(checked))<(len(lake._nodes)): #while not every downnode is reset
-
-            r,c=int(checknode.get_y()/self.getCellsize()), int(checknode.get_x()/self.getCellsize())
-            neighbours = self.getNeighbours(r,c) #get new neighbours of checknode
-
-            for n in neighbours:
-                if lake.isLake(n) and n not in tocheck and n not in checked: #if downnode is not set yet
-                    n.setDownnode(checknode) #set a downnode from neighbour to checknode
-                    tocheck.append(n) #append the new neigbours
-            
-            tocheck.remove(checknode) #remove the checknode
-            checked.append(checknode) #append the checked to checked
-
-            nearest=self.getNearest(lake._outflow, tocheck) #nearest from outflow
-            checknode=nearest
+        nodes=self._data.ravel()
+        cells=[n.getRow()*self.getCols()+n.getCol() for n in lake._nodes]
+        outflow=lake._outflow.getRow()*self.getCols()+lake._outflow.getCol()
+        drained,downnodes=drainLake(cells, outflow, self.getShape())
+        for cell, down in zip(drained, downnodes):
+            nodes[cell].setDownnode(nodes[down]) #set a downnode from the lake node towards the outflow
         
         #set lake downnode of outflow
-        x=int(lake._outflow.get_x()/self.getCellsize())
-        y=int(lake._outflow.get_y()/self.getCellsize())
-        lake._outflow.setDownnode(self.lowestNeighbour(y,x)) #set outflows downnodes
-     
+        lake._outflow.setDownnode(self._outflowDownnode(lake._outflow)) #set outflows downnodes
     
     
+    def _isEdgeNode(self, node):
+        """Returns True if the node lies on the raster edge"""
+        r,c=node.getRow(), node.getCol()
+        return r==0 or c==0 or r==(self.getRows()-1) or c==(self.getCols()-1)
+    
+    
+    def _outflowDownnode(self, outflow):
+        """Returns the downnode of a lake outflow
+        
+        This is the lowest neighbour, unless water would flow from it back to 
+        the outflow, which happens on flats where lake cells are as high as the 
+        outflow. Then the next lowest neighbour is taken, None if all lead back.
+        
+        Input Parameter:
+            outflow – the outflow, a FlowNode object
+        """
+        neighbours=sorted(self.getNeighbours(outflow.getRow(), outflow.getCol()), key=FlowNode.getElevation) #stable, first lowest like lowestNeighbour
+        for neighbour in neighbours:
+            node=neighbour
+            while node is not None and node is not outflow:
+                node=node.getDownnode()
+            if node is None: #reaches a pitflag without passing the outflow
+                return neighbour
+        return None
+     
     
     def getNearest(self, node, nodelist):
         """Returns nearest point from nodelist to node
@@ -406,32 +587,81 @@ class FlowRaster(Raster):
     def setDownnodes(self):
         """Calculates Downnodes and sets them for each FlowNode object
         
+        The D8 directions of the whole grid are calculated at once with 
+        FlowEngine.d8Downnodes, only the resulting links are set on the nodes
+        
         """
-        for r in range(self.getRows()):
-            for c in range(self.getCols()):
-                lowestN = self.lowestNeighbour(r,c)
-                if (lowestN.getElevation() < self._data[r,c].getElevation()):
-                    self._data[r,c].setDownnode(lowestN) #set downnode, upnode is set within the FlowNode class
+        elevation=np.fromiter((node.getElevation() for node in self._data.flat), dtype=float, count=self._data.size)
+        downnodes,pitflags=d8Downnodes(elevation.reshape(self._data.shape))
+        nodes=self._data.ravel()
+        for index in np.flatnonzero(~pitflags):
+            nodes[index].setDownnode(nodes[downnodes.flat[index]]) #set downnode, upnode is set within the FlowNode class
 
     
+    def _edgeMask(self):
+        """Returns a read-only 2d bool array which is True for the cells on the raster edge
+        
+        The mask only depends on the shape of the raster and is created once
+        """
+        if self._edge is None:
+            self._edge=np.zeros(self.getShape(), dtype=bool)
+            self._edge[[0,-1],:]=True
+            self._edge[:,[0,-1]]=True
+            self._edge.flags.writeable=False
+        return self._edge
+    
+    
+    def getFlowStatistics(self, constRain=None, k=10):
+        """Calculates the statistics of the flows from one flow grid
+        
+        All values are numpy reductions of the (cached) flow grid of 
+        getFlowGrid(), the outflow is summed over the edge pitflags
+        
+        Input Parameter:
+            constRain – constant rain per cell in mm, if left out the rainfall per cell is used
+            k – number of cells with the highest flows to return
+        
+        Returns:
+            a dictionary with
+                maxflow: maximum flow
+                maxcell: (row, col) of the cell with the maximum flow (the first one when equal)
+                topflows: numpy array with the k highest flows, highest first
+                topcells: int numpy array of shape (k, 2) with (row, col) of these cells
+                totalRainfall: total rainfall over all cells
+                totalOutflow: total flow leaving the raster at edge pitflags
+                residual: totalRainfall minus totalOutflow, zero when the mass balance holds
+        """
+        flow=self.getFlowGrid(constRain).ravel()
+        maxindex=int(np.argmax(flow))
+        k=min(k, flow.size)
+        top=np.argpartition(-flow, k-1)[:k] if k>0 else np.array([], dtype=np.int64)
+        top=top[np.lexsort((top, -flow[top]))] #highest first, row by row when equal
+        outlets=(self._getTopology()[0]<0) & self._edgeMask().ravel()
+        if constRain is None:
+            totalRainfall=float(np.sum(self._getRainfallArray()))
+        else:
+            totalRainfall=float(constRain*flow.size)
+        totalOutflow=float(flow[outlets].sum())
+        return {"maxflow": flow[maxindex],
+                "maxcell": divmod(maxindex, self.getCols()),
+                "topflows": flow[top],
+                "topcells": np.column_stack(np.divmod(top, self.getCols())),
+                "totalRainfall": totalRainfall,
+                "totalOutflow": totalOutflow,
+                "residual": totalRainfall-totalOutflow}
+    
+    
     def getMaximumFlow(self):
         """Calculates the maximum flow within the FlowRaster
         
         Returns:
             a tuple – (maxrate, maxnode)
                     maxrate: maximum flow rate, a float
-                    maxnode: node with maximum flow rate, a Flownode object
+                    maxnode: node with maximum flow rate, a FlowNode object
         """
         flow=self.extractValues(FlowExtractor()) #get flow data
-        maxrate=None
-        maxnode=None
-        for i in range(flow.shape[0]): #iterate through data
-            for j in range(flow.shape[1]): #iterate through data
-                if maxrate is None or flow[i,j]>maxrate:
-                    maxrate=flow[i,j]
-                    maxnode=(i,j)
-        return (maxrate, self._data[maxnode[0],maxnode[1]])
-    
+        maxindex=int(np.argmax(flow)) #first maximum, row by row
+        return (flow.flat[maxindex], self.getNode(*divmod(maxindex, self.getCols())))
     
     
     def getTotalRainfall(self):
@@ -440,44 +670,416 @@ class FlowRaster(Raster):
         Returns:
             total rainfall – a number
         """
-        rainfall=self.extractValues(RainfallExtractor())
-        total=0
-        for i in range(rainfall.shape[0]): #iterate through data
-            for j in range(rainfall.shape[1]): #iterate through data
-                total+=rainfall[i,j] #add rainfall
-        return total
+        return float(np.sum(self._getRainfallArray()))
         
     
     def getTotalFlow(self):
-        """Calculates the total flow over all cells
+        """Calculates the total flow leaving the raster at edge pitflags
         
         Returns:
             total flow – a number
         """
-        flow=self.extractValues(FlowExtractor())
-        total=0
-        for i in range(flow.shape[0]): #iterate through data
-            for j in range(flow.shape[1]): #iterate through data
-                edgecase = i==0 or j==0 or i==(self._data.shape[0]-1) or j==(self._data.shape[1]-1)
-                if self._data[i,j].getPitFlag() and edgecase:
-                    total+=flow[i,j]
-        return total
+        flow=self.extractValues(FlowExtractor()).ravel()
+        return float(flow[(self._getTopology()[0]<0) & self._edgeMask().ravel()].sum())
     
     
     def extractValues(self, extractor):
         """Extract values from FlowRaster object
         
+        Extractors with a getGrid() method return the whole grid at once from 
+        the arrays of the raster, e.g. flows from getFlowGrid(), which calculates 
+        all of them in one sweep. Other extractors are asked for every node 
+        with getValue().
+        
         Input Parameter:
-            extractor – A FlowExtractor class object
+            extractor – an extractor object, e.g. a FlowExtractor
         """
+        if hasattr(extractor, "getGrid"):
+            return extractor.getGrid(self)
         values=[]
-        for i in range(self._data.shape[0]): #iterate through data
-            for j in range(self._data.shape[1]): #iterate through data
-                values.append(extractor.getValue(self._data[i,j]))
+        for i in range(self.getRows()): #iterate through data
+            for j in range(self.getCols()): #iterate through data
+                values.append(extractor.getValue(self.getNode(i,j)))
         valuesarray=np.array(values) #convert to numpy array
-        valuesarray.shape=self._data.shape #reshape
+        valuesarray.shape=self.getShape() #reshape
         return valuesarray
     
+    
+    def getFlowGrid(self, constRain=None):
+        """Calculates the flow of every cell
+        
+        The cells are ordered topologically once and the rain is then summed 
+        down the downnode graph (see FlowEngine.accumulateFlow), which is 
+        linear in the number of cells
+        
+        The grid is cached per rain configuration until the network or the 
+        rainfall changes, the returned array is therefore read-only
+        
+        Input Parameter:
+            constRain – constant rain per cell in mm, if left out the rainfall per cell is used
+        
+        Returns:
+            flow – numpy array with the flow of each cell, shape of the raster
+        """
+        if constRain in self._flowCache:
+            self._cacheHits+=1
+            return self._flowCache[constRain]
+        self._cacheMisses+=1
+        downnodes,levels=self._getTopology()
+        if self._workers is None:
+            flow=accumulateFlow(downnodes, self._getRainfallArray(constRain), levels)
+        else:
+            flow,self._basinCache[constRain]=parallelAccumulateFlow(downnodes, self._getRainfallArray(constRain), levels, self._workers)
+        flow=flow.reshape(self.getShape())
+        flow.flags.writeable=False
+        self._flowCache[constRain]=flow
+        return flow
+    
+    
+    def getFlowStack(self, rainfallStack):
+        """Calculates the flows of several rain scenarios on the same network
+        
+        All scenarios are accumulated in one sweep over the topological 
+        levels of the network, so the network is only traversed once
+        
+        Input Parameter:
+            rainfallStack – numpy array of shape (k, rows, cols) with the rainfall of k scenarios
+        
+        Returns:
+            a tuple (flows, statistics)
+                flows: numpy array of shape (k, rows, cols) with the flow of each scenario
+                statistics: a dictionary with one entry per scenario, 
+                            the same keys as getFlowStatistics
+                    maxflow: numpy array with the maximum flow
+                    maxcell: list of (row, col) tuples of the cell with the maximum flow
+                    totalRainfall: numpy array with the total rainfall
+                    totalOutflow: numpy array with the total flow leaving the raster at edge pitflags
+        """
+        rainfallStack=np.asarray(rainfallStack, dtype=float)
+        assert rainfallStack.shape[1:]==self.getShape() #assert that same shape
+        k=rainfallStack.shape[0]
+        downnodes,levels=self._getTopology()
+        flows=accumulateFlow(downnodes, rainfallStack, levels)
+        
+        flat=flows.reshape(k, -1)
+        maxindex=np.argmax(flat, axis=1)
+        outlets=(downnodes<0) & self._edgeMask().ravel()
+        statistics={"maxflow": flat[np.arange(k), maxindex],
+                    "maxcell": [divmod(index, self.getCols()) for index in maxindex.tolist()],
+                    "totalRainfall": rainfallStack.reshape(k, -1).sum(axis=1),
+                    "totalOutflow": flat[:, outlets].sum(axis=1)}
+        return flows, statistics
+    
+    
+    def streamRainfall(self, rainfallFrames):
+        """Calculates the flow of a sequence of rainfall grids, e.g. radar frames of a storm
+        
+        The frames are consumed one at a time from any iterable, so the time 
+        series is never held in memory. The network topology is calculated 
+        once and every frame is accumulated into the same preallocated buffer
+        
+        The yielded flow grid is overwritten by the next step, copy it 
+        to keep it. The rainfall of the nodes is not changed
+        
+        Input Parameter:
+            rainfallFrames – iterable of numpy arrays with the rainfall of each time step, shape of the raster
+        
+        Yields:
+            a tuple (flow, totals) per time step
+                flow: numpy array with the flow of each cell in this step
+                totals: a dictionary, the keys of getFlowStatistics for this step and the running sums
+                    step: index of the time step
+                    maxflow: maximum flow of this step
+                    maxcell: (row, col) of the cell with the maximum flow
+                    totalRainfall: total rainfall of this step
+                    totalOutflow: total flow leaving the raster at edge pitflags in this step
+                    cumulativeRainfall: totalRainfall summed over all steps so far
+                    cumulativeOutflow: totalOutflow summed over all steps so far
+        """
+        downnodes,levels=self._getTopology()
+        outlets=(downnodes<0) & self._edgeMask().ravel()
+        flow=np.empty(self.getShape())
+        cumulativeRainfall=0.
+        cumulativeOutflow=0.
+        for step, rainfall in enumerate(rainfallFrames):
+            assert np.shape(rainfall)==self.getShape() #assert that same shape
+            accumulateFlow(downnodes, rainfall, levels, out=flow)
+            maxindex=int(np.argmax(flow))
+            rainfall=float(np.sum(rainfall))
+            outflow=float(flow.ravel()[outlets].sum())
+            cumulativeRainfall+=rainfall
+            cumulativeOutflow+=outflow
+            yield flow, {"step": step,
+                         "maxflow": flow.ravel()[maxindex],
+                         "maxcell": divmod(maxindex, self.getCols()),
+                         "totalRainfall": rainfall,
+                         "totalOutflow": outflow,
+                         "cumulativeRainfall": cumulativeRainfall,
+                         "cumulativeOutflow": cumulativeOutflow}
+    
+    
+    def setWorkers(self, workers):
+        """Sets the parallel execution mode for flow calculations
+        
+        With workers set, flows are accumulated basin by basin in a process 
+        pool (see ParallelFlow.parallelAccumulateFlow), basins draining to 
+        different pitflags share no cells
+        
+        Input Parameter:
+            workers – number of worker processes, 0 for one per cpu, None to calculate in this process
+        """
+        if workers==0:
+            workers=os.cpu_count() or 1
+        self._workers=workers
+    
+    
+    def getBasinStatistics(self, constRain=None):
+        """Returns statistics of each drainage basin (the cells draining to the same pitflag)
+        
+        The statistics are calculated along with the flows, in parallel if 
+        setWorkers() was called, and are cached like the flows
+        
+        Input Parameter:
+            constRain – constant rain per cell in mm, if left out the rainfall per cell is used
+        
+        Returns:
+            a dictionary of arrays with one entry per basin, see ParallelFlow.parallelAccumulateFlow
+        """
+        if constRain not in self._basinCache:
+            downnodes,levels=self._getTopology()
+            flow,self._basinCache[constRain]=parallelAccumulateFlow(downnodes, self._getRainfallArray(constRain), levels, self._workers or 1)
+            if constRain not in self._flowCache:
+                flow=flow.reshape(self.getShape())
+                flow.flags.writeable=False
+                self._flowCache[constRain]=flow
+        return self._basinCache[constRain]
+    
+    
+    def getDownnodes(self):
+        """Returns the flow network as a flat downnode array
+        
+        The array is cached with the network, later calls until the network 
+        changes return the same values without walking the cells again.
+        
+        Returns:
+            downnodes – read-only int numpy array with the flat index (row*cols+col) 
+                        of the downnode of each cell, -1 for pitflags
+        """
+        downnodes=self._getTopology()[0].view()
+        downnodes.flags.writeable=False
+        return downnodes
+    
+    
+    def getUpstreamGraph(self):
+        """Returns the reverse flow graph in compressed sparse row form
+        
+        The upnodes of the cell with flat index i (row*cols+col) are 
+        upnodes[offsets[i]:offsets[i+1]]. The graph is built in one pass from 
+        the downnodes (see FlowEngine.upstreamGraph) and cached until the 
+        network changes.
+        
+        Returns:
+            a tuple (offsets, upnodes) of int arrays
+        """
+        if self._upstream is None:
+            self._upstream=upstreamGraph(self._getDownnodeArray())
+        return self._upstream
+    
+    
+    def getCatchment(self, r, c):
+        """Delineates the catchment of a cell, all cells draining through it
+        
+        Input Parameter:
+            r – row of the cell
+            c – column of the cell
+        
+        Returns:
+            catchment – bool numpy array, True for the cells of the catchment, shape of the raster
+        """
+        offsets,upnodes=self.getUpstreamGraph()
+        catchment=np.zeros(self.getShape(), dtype=bool)
+        catchment.flat[catchmentCells(offsets, upnodes, [r*self.getCols()+c])]=True
+        return catchment
+    
+    
+    def getWatershedLabels(self):
+        """Labels every cell with the outlet (pitflag) it drains to
+        
+        The labels are passed up the network level by level in one sweep 
+        (see FlowEngine.basinLabels) and cached until the network changes
+        
+        Returns:
+            labels – read-only int numpy array with the flat index (row*cols+col) 
+                     of the outlet of each cell, shape of the raster
+        """
+        if self._labels is None:
+            downnodes,levels=self._getTopology()
+            self._labels=basinLabels(downnodes, levels).reshape(self.getShape())
+            self._labels.flags.writeable=False
+        return self._labels
+    
+    
+    def getOutletCatchment(self, r, c):
+        """Returns the catchment of an outlet and its totals
+        
+        The totals of all outlets are summed up together the first time and 
+        cached, later queries only look them up
+        
+        Input Parameter:
+            r – row of the outlet, a pitflag
+            c – column of the outlet
+        
+        Returns:
+            a dictionary with
+                mask: bool numpy array, True for the cells draining to the outlet
+                cells: number of cells in the catchment
+                area: area of the catchment (cells times cellsize squared)
+                rainfall: total rainfall on the catchment
+                lakeVolume: volume of the lakes in the catchment (lake depth times cell area)
+        """
+        index=r*self.getCols()+c
+        if self._getTopology()[0][index]>=0:
+            raise ValueError("cell ({}, {}) is no outlet".format(r, c))
+        labels=self.getWatershedLabels()
+        if self._catchments is None:
+            flat=labels.ravel()
+            cellArea=self.getCellsize()**2
+            lakedepth=self.extractValues(LakeDepthExtractor()).ravel()
+            self._catchments={"cells": np.bincount(flat, minlength=flat.size),
+                              "rainfall": np.bincount(flat, weights=self._getRainfallArray(), minlength=flat.size),
+                              "lakeVolume": np.bincount(flat, weights=lakedepth, minlength=flat.size)*cellArea}
+        cells=int(self._catchments["cells"][index])
+        return {"mask": labels==index,
+                "cells": cells,
+                "area": cells*self.getCellsize()**2,
+                "rainfall": self._catchments["rainfall"][index],
+                "lakeVolume": self._catchments["lakeVolume"][index]}
+    
+    
+    def getFlowCacheStats(self):
+        """Returns the counters of the flow cache
+        
+        Returns:
+            a dictionary with
+                hits: number of flow grids served from the cache
+                misses: number of flow grids that had to be calculated
+                invalidations: number of times cached flows were dropped
+                cached: number of flow grids currently in the cache
+        """
+        return {"hits": self._cacheHits, "misses": self._cacheMisses,
+                "invalidations": self._cacheInvalidations, "cached": len(self._flowCache)}
+    
+    
+    def enableProfiling(self):
+        """Starts recording wall time per stage and counters in a new FlowProfile
+        
+        The stage methods of this raster are wrapped on the instance (see 
+        Profiling.instrumentRaster), the class is unchanged. Growing lakes 
+        record themselves in the profile (see FlowProfile.addLake). 
+        Stage times include the nested stages, e.g. createLake is part of calculateLakes.
+        
+        Returns:
+            the FlowProfile object, also returned by getProfile()
+        """
+        self.disableProfiling()
+        self._profile=FlowProfile()
+        instrumentRaster(self, self._profile)
+        return self._profile
+    
+    
+    def disableProfiling(self):
+        """Removes the profiling wrappers, the last profile stays readable from the returned object
+        
+        Returns:
+            the FlowProfile object, None if profiling was not enabled
+        """
+        profile=self._profile
+        uninstrument(self)
+        self._profile=None
+        return profile
+    
+    
+    def getProfile(self):
+        """Returns the FlowProfile object, None if profiling is not enabled"""
+        return self._profile
+    
+    
+    def _resetFlowCache(self):
+        """Creates an empty flow cache and resets its counters"""
+        self._flowCache={} #flow grids by constant rain, None for the rainfall per cell
+        self._basinCache={} #basin statistics, same keys as the flow grids
+        self._topology=None #(downnodes, levels) of the current network
+        self._upstream=None #(offsets, upnodes) of the current network
+        self._labels=None #outlet each cell drains to
+        self._catchments=None #cells, rainfall and lake volume per outlet
+        self._edge=None #edge mask, depends only on the shape
+        self._workers=None #number of worker processes, None calculates flows in this process
+        self._cacheHits=0
+        self._cacheMisses=0
+        self._cacheInvalidations=0
+        
+        
+    def _invalidateFlows(self, rainfallOnly=False):
+        """Drops cached flows after their inputs changed
+        
+        Input Parameter:
+            rainfallOnly – True if only the rainfall per cell changed, 
+                           flows with constant rain and the network stay valid
+        """
+        self._catchments=None
+        if rainfallOnly:
+            self._basinCache.pop(None, None)
+            if None in self._flowCache:
+                del self._flowCache[None]
+                self._cacheInvalidations+=1
+        elif self._flowCache or self._basinCache or self._topology is not None or self._upstream is not None or self._labels is not None:
+            self._flowCache={}
+            self._basinCache={}
+            self._topology=None
+            self._upstream=None
+            self._labels=None
+            self._cacheInvalidations+=1
+            
+            
+    def _getTopology(self):
+        """Returns the (cached) downnode array and its topological levels"""
+        if self._topology is None:
+            downnodes=self._getDownnodeArray()
+            self._topology=(downnodes, topologicalLevels(downnodes))
+        return self._topology
+    
+    
+    def _getDownnodeArray(self):
+        """Returns a flat int array with the flat index of each downnode, -1 for pitflags"""
+        nodes=self._data.ravel()
+        position={id(node): index for index, node in enumerate(nodes)}
+        downnodes=np.full(nodes.size, -1, dtype=np.int64)
+        for index, node in enumerate(nodes):
+            if node.getDownnode() is not None:
+                downnodes[index]=position[id(node.getDownnode())]
+        return downnodes
+    
+    
+    def _getRainfallArray(self, constRain=None):
+        """Returns a flat float array with the rain per cell
+        
+        Input Parameter:
+            constRain – constant rain per cell, if None the rainfall per node is used (None counts as 0)
+        """
+        if constRain is not None:
+            return np.full(self._data.size, constRain, dtype=float)
+        return np.fromiter((0. if node.getRainfall() is None else node.getRainfall() for node in self._data.flat), dtype=float, count=self._data.size)
+    
+    
+    def _getElevationArray(self):
+        """Returns a flat float array with the elevation of each node"""
+        return np.fromiter((node.getElevation() for node in self._data.flat), dtype=float, count=self._data.size)
+    
+    
+    def _getLakeDepthArray(self):
+        """Returns a flat float array with the lake depth of each node"""
+        return np.fromiter((node.getLakeDepth() for node in self._data.flat), dtype=float, count=self._data.size)
+    
 
     
     
@@ -499,10 +1101,724 @@ class FlowRaster(Raster):
 
 
 
+class FlowNodeView():
+    """A lightweight view of a single cell of an ArrayFlowRaster
+    
+    Offers the read methods of FlowNode, but the values are read from
+    the arrays of the raster, so views are only created when asked for
+    
+    """
+    
+    __slots__=("_raster","_index")
+    
+    def __init__(self, raster, index):
+        """Constructor for FlowNodeView
+        
+        Input Parameter:
+            raster – the ArrayFlowRaster object the cell belongs to
+            index – flat index of the cell within the raster (row*cols+col)
+        """
+        self._raster=raster
+        self._index=index
+        
+        
+    def getIndex(self):
+        """Returns the flat index of the cell"""
+        return self._index
+    
+    
+    def getRowCol(self):
+        """Returns the (row, col) tuple of the cell"""
+        return divmod(self._index, self._raster.getCols())
+    
+    
+    def getRow(self):
+        """Returns the row of the cell (int), like FlowNode.getRow"""
+        return self._index//self._raster.getCols()
+    
+    
+    def getCol(self):
+        """Returns the column of the cell (int), like FlowNode.getCol"""
+        return self._index%self._raster.getCols()
+    
+    
+    def get_x(self):
+        """returns x coordinate"""
+        return self.getRowCol()[1]*self._raster.getCellsize()+self._raster.getOrgs()[1]
+    
+    
+    def get_y(self):
+        """returns y coordinate"""
+        return self.getRowCol()[0]*self._raster.getCellsize()+self._raster.getOrgs()[0]
+    
+    
+    def distance(self, other_point):
+        """calculates and return distance"""
+        xd=self.get_x()-other_point.get_x()
+        yd=self.get_y()-other_point.get_y()
+        return np.sqrt((xd*xd)+(yd*yd))
+        
+    
+    def getDownnode(self):
+        """
+        Returns:
+           the downnode, a FlowNodeView object or None for pitflags
+        """
+        down=self._raster._downnode[self._index]
+        if down<0:
+            return None
+        return FlowNodeView(self._raster, int(down))
+    
+    
+    def getUpnodes(self):
+        """
+        Returns:
+           a list of FlowNodeView objects draining into this cell
+        """
+        return [FlowNodeView(self._raster, n) for n in self._raster._upnodeIndices(self._index)]
+    
+    
+    def numUpnodes(self):
+        """
+        Returns:
+           number of Upnodes
+        """
+        return len(self._raster._upnodeIndices(self._index))
+    
+    
+    def getPitFlag(self):
+        """
+        Returns:
+           True when it is a pitFlag(=no downnodes), else False
+        """
+        return bool(self._raster._pitflag[self._index])
+    
+    
+    def getElevation(self):
+        """
+        Returns:
+            elevation in m at the cell
+        """
+        return self._raster._elevation[self._index]
+    
+    
+    def getRainfall(self):
+        """
+        Returns:
+            rain at the cell in mm, None when no rainfall was added
+        """
+        if self._raster._rainfall is None:
+            return None
+        return self._raster._rainfall[self._index]
+    
+    
+    def getLakeDepth(self):
+        """
+        Returns:
+            lake depth at the cell, zero when the cell is not a lake
+        """
+        return self._raster._lakedepth[self._index]
+    
+    
+    def getFlow(self, constRain=None):
+        """Adds up the rain of the cell and of all cells upstream of it
+        
+        Input Parameter:
+            constRain – constant rain per node in mm, if left out the rainfall per node value is used
+        """
+        flow=0
+        tovisit=[self._index]
+        while tovisit:
+            index=tovisit.pop()
+            if constRain is not None:
+                flow+=constRain
+            elif self._raster._rainfall is not None:
+                flow+=self._raster._rainfall[index]
+            tovisit.extend(self._raster._upnodeIndices(index))
+        return flow
+    
+    
+    def __eq__(self, other):
+        """Two views are equal when they look at the same cell of the same raster"""
+        return isinstance(other, FlowNodeView) and other._raster is self._raster and other._index==self._index
+    
+    
+    def __hash__(self):
+        return hash((id(self._raster), self._index))
+    
+    
+    def __str__(self):
+        """String representation of FlowNodeView object
+        
+        """
+        downnode= -999
+        if self.getDownnode() is not None:
+            downnode =self.getDownnode().getElevation()
+        return "Flownode y={}, x={}, elevation={} downnode={}".format(self.get_y(), self.get_x(), self.getElevation(), downnode)
+    
+    
+    def __repr__(self):
+        return self.__str__()
+    
+    
+    
+    
+class ArrayFlowRaster(FlowRaster):
+    """A FlowRaster which keeps its cells in flat numpy arrays
+    
+    Elevation, downnode index, pitflag, rainfall and lake depth are stored 
+    as one array each instead of one FlowNode object per cell. Cells are 
+    addressed by their flat index (row*cols+col), a downnode index of -1 
+    marks a pitflag. FlowNodeView objects are only created when a caller 
+    asks for a node, e.g. with getNode() or getPitflags().
+    
+    Inherits from FlowRaster
+    """
+    
+    def __init__(self, araster, profile=False):
+        """Constructor for ArrayFlowRaster
+        
+        Input Parameter:
+            araster – a Raster class object
+            profile – if True, profiling is enabled before the downnodes are calculated (see enableProfiling)
+        
+        """
+        Raster.__init__(self, None, araster.getOrgs()[0], araster.getOrgs()[1], araster.getCellsize())
+        self._resetFlowCache()
+        data=np.asarray(araster.getData(), dtype=float)
+        self._elevation=data.ravel().copy() #elevation, changes when lakes are filled
+        self._data=self._elevation.reshape(data.shape) #2d view, keeps getRows() etc. working
+        self._downnode=np.full(self._elevation.size, -1, dtype=np.int64)
+        self._pitflag=np.ones(self._elevation.size, dtype=bool)
+        self._rainfall=None #set with addRainfall()
+        self._lakedepth=np.zeros(self._elevation.size)
+        
+        #neighbours as plain ints, same order as FlowRaster: (row, col) offsets 
+        #for cells on the edge, flat index offsets for all other cells
+        self._offsets=[(1,-1),(1,0),(1,1),(0,-1),(0,1),(-1,-1),(-1,0),(-1,1)]
+        self._flatOffsets=[dr*data.shape[1]+dc for dr,dc in self._offsets]
+        self._profile=None
+        if profile:
+            self.enableProfiling()
+        self.setDownnodes() #calculate downnodes
+        self._lakes=[]
+        self._lakeEngine=None #engine the lakes were calculated with
+        
+        
+    def getNode(self, r, c):
+        """Returns a view of the cell at row r and column c
+        
+        Input Parameter:
+            r – row of the cell (int)
+            c – column of the cell (int)
+        
+        Returns:
+            a FlowNodeView object
+        """
+        return FlowNodeView(self, r*self.getCols()+c)
+    
+    
+    def _isEdge(self, index):
+        """Returns True if the cell with the flat index lies on the raster edge"""
+        rows,cols=self._data.shape
+        r,c=divmod(index, cols)
+        return r==0 or c==0 or r==(rows-1) or c==(cols-1)
+    
+    
+    def _neighbourIndices(self, index):
+        """Returns the flat indices of the (up to) eight neighbours of a cell
+        
+        Input Parameter:
+            index – flat index of the cell
+        """
+        index=int(index)
+        rows,cols=self._data.shape
+        r,c=divmod(index, cols)
+        if 0<r<rows-1 and 0<c<cols-1: #all eight neighbours exist, no bounds checks needed
+            return [index+offset for offset in self._flatOffsets]
+        return [(r+dr)*cols+c+dc for dr,dc in self._offsets if -1<r+dr<rows and -1<c+dc<cols]
+    
+    
+    def _upnodeIndices(self, index):
+        """Returns the flat indices of the neighbours draining into a cell
+        
+        Input Parameter:
+            index – flat index of the cell
+        """
+        return [n for n in self._neighbourIndices(index) if self._downnode[n]==index]
+    
+    
+    def _lowestNeighbourIndex(self, index):
+        """Returns the flat index of the lowest neighbour, excluding the cell itself"""
+        lowest=None
+        for n in self._neighbourIndices(index):
+            if lowest is None or self._elevation[n]<self._elevation[lowest]:
+                lowest=n
+        return lowest
+    
+    
+    def _setDownnode(self, index, down):
+        """Sets the downnode of a cell, -1 turns the cell into a pitflag"""
+        if self._downnode[index]!=down:
+            self._invalidateFlows()
+        self._downnode[index]=down
+        self._pitflag[index]=(down<0)
+    
+    
+    def getNeighbours(self, r, c):
+        """Returns the eight neighbours of a cell
+        
+        Input Parameter:
+            r – row of the cell
+            c – column of the cell
+        
+        Returns:
+            neighbours – a list of FlowNodeView objects
+        """
+        return [FlowNodeView(self, n) for n in self._neighbourIndices(r*self.getCols()+c)]
+    
+    
+    def lowestNeighbour(self, r, c):
+        """Calculates the lowest neighbour, excluding itself
+        
+        Input Parameter:
+            r – row of the cell
+            c – column of the cell
+        
+        Returns:
+            the lowest neighbour, a FlowNodeView object
+        """
+        return FlowNodeView(self, self._lowestNeighbourIndex(r*self.getCols()+c))
+    
+    
+    def setDownnodes(self):
+        """Calculates the downnode index and pitflag of each cell
+        
+        """
+        downnodes,pitflags=d8Downnodes(self._data)
+        self._downnode=downnodes.ravel()
+        self._pitflag=pitflags.ravel()
+        self._invalidateFlows()
+    
+    
+    def getPitflags(self):
+        """Returns a list of pitflag nodes
+        
+        Returns:
+            pitflags – a list of FlowNodeView objects
+        """
+        return [FlowNodeView(self, int(i)) for i in np.flatnonzero(self._pitflag)]
+    
+    
+    def calculateLakes(self, engine="path"):
+        """Calculates lakes from pitflags, fills them up to the lake outflow and 
+        resets the downnodes of the lake cells towards the outflow
+        
+        The lakes are stored in self._lakes, a list of (cells, outflow) tuples 
+        with the flat indices of the lake cells and of the outflow
+        
+        Input Parameter:
+            engine – "path" (default) grows a lake from every pitflag, 
+                     "priorityflood" fills all depressions in one pass (see fillDepressions)
+        
+        """
+        if engine=="priorityflood":
+            self.fillDepressions()
+            return
+        elif engine!="path":
+            raise ValueError("unknown lake engine: {}".format(engine))
+        
+        self._lakeEngine="path"
+        for pit in np.flatnonzero(self._pitflag):
+            #check again if pitflag because it might have changed when two lakes grow together
+            if self._pitflag[pit] and not(self._isEdge(pit)):
+                self._lakes.append(self._growLake(int(pit)))
+                
+        for cells, outflow in self._lakes:
+            self._drainLake(cells, outflow)
+        enclosed=self._fillEnclosedOutflows()
+        for cells, outflow in self._lakes:
+            assert not(self._pitflag[outflow]) or self._isEdge(outflow) #edge outflows of flats drain off the raster
+        self._lakes.extend(enclosed)
+        self._invalidateFlows()
+        
+        
+    def _fillEnclosedOutflows(self):
+        """Fills the depressions around lake outflows that were left without an exit, 
+        see FlowRaster._fillEnclosedOutflows
+        
+        Returns:
+            the filled depressions, a list of (cells, outflow) tuples
+        """
+        enclosed=np.flatnonzero(self._pitflag & ~self._edgeMask().ravel())
+        if enclosed.size==0:
+            return []
+        cells=np.flatnonzero(np.isin(basinLabels(self._downnode), enclosed))
+        filled,parents=priorityFlood(self._data, self._pitflag.reshape(self.getShape()) & self._edgeMask())
+        downnodes,pitflags=floodDownnodes(filled, parents)
+        depth=np.zeros(self._elevation.size)
+        depth[cells]=filled.ravel()[cells]-self._elevation[cells]
+        self._lakedepth[cells]+=depth[cells]
+        self._elevation[cells]=filled.ravel()[cells]
+        self._downnode[cells]=downnodes.ravel()[cells]
+        self._pitflag[cells]=pitflags.ravel()[cells]
+        return groupLakes(lakeOutflows(depth, self._downnode))
+        
+        
+    def fillDepressions(self):
+        """Fills all depressions at once with a priority flood from the raster edge
+        
+        Works like FlowRaster.fillDepressions, but on the arrays of the raster. 
+        The lakes are stored in self._lakes as (cells, outflow) tuples.
+        """
+        filled,parents=priorityFlood(self._data, self._pitflag.reshape(self.getShape()) & self._edgeMask())
+        downnodes,pitflags=floodDownnodes(filled, parents)
+        depth=filled.ravel()-self._elevation
+        self._lakedepth+=depth
+        self._elevation[:]=filled.ravel()
+        self._downnode=downnodes.ravel()
+        self._pitflag=pitflags.ravel()
+        self._lakes.extend(groupLakes(lakeOutflows(depth, self._downnode)))
+        self._lakeEngine="priorityflood"
+        self._invalidateFlows()
+        
+        
+    def updateElevations(self, cells, elevations):
+        """Changes the elevation of some cells and re-routes only the affected part of the network
+        
+        Meant for small corrections of the DEM, e.g. a culvert or an embankment. 
+        The D8 downnodes are recalculated around the changed cells. If the lakes 
+        were filled with the priority flood engine, only the depressions the 
+        change can reach are filled again: the cells draining through the 
+        changed cells and the lakes next to them. Cached flows are updated 
+        along the old and new downstream paths of the re-routed cells. 
+        The cost grows with the affected area, not with the raster size.
+        
+        Input Parameter:
+            cells – list of (row, col) tuples of the changed cells
+            elevations – list with the new (unfilled) elevation of each cell
+        """
+        if self._lakeEngine=="path":
+            raise ValueError("incremental updates need lakes from the priorityflood engine")
+        shape=self.getShape()
+        changed=np.array([r*self.getCols()+c for r,c in cells], dtype=np.int64)
+        elevations=np.asarray(elevations, dtype=float)
+        around=np.unique(np.r_[changed, neighbourCells(changed, shape).ravel()])
+        around=around[around>=0]
+        
+        if self._lakeEngine is None:
+            self._elevation[changed]=elevations
+            self._rerouteCells(around, d8Cells(self._data, around))
+            return
+        
+        dem=self._elevation-self._lakedepth
+        edge=around[self._isEdgeArray(around)]
+        outlets=d8Cells(dem.reshape(shape), edge)<0 #edge pitflags of the unfilled surface
+        dem[changed]=elevations
+        newOutlets=d8Cells(dem.reshape(shape), edge)<0
+        sources=np.r_[changed, edge[outlets!=newOutlets]]
+        
+        islake=self._lakedepth>0
+        region=np.zeros(self._elevation.size, dtype=bool)
+        region[upstreamCells(self._downnode, sources, shape)]=True #cells whose fill may rise
+        region[connectedCells(islake, np.r_[sources, neighbourCells(sources, shape).ravel()], shape)]=True #may drain
+        while True:
+            cells=np.flatnonzero(region)
+            filled,parents=self._floodRegion(cells, dem)
+            grow=self._regionBoundary(cells, filled, islake)
+            if not grow.size:
+                break
+            region[connectedCells(islake, grow, shape)]=True
+            region[grow]=True
+        
+        rerouted=np.unique(np.r_[cells, neighbourCells(cells, shape).ravel()])
+        rerouted=rerouted[rerouted>=0]
+        outflows=lakeOutflows(self._lakedepth, self._downnode, rerouted) #lakes touched by the region
+        outflows=set(outflows[outflows>=0].tolist())
+        touched=[lake[1] in outflows or region[lake[1]] for lake in self._lakes]
+        relake=[lake[0] for lake, t in zip(self._lakes, touched) if t]
+        self._lakes=[lake for lake, t in zip(self._lakes, touched) if not t]
+        self._elevation[cells]=filled
+        self._lakedepth[cells]=filled-dem[cells]
+        self._catchments=None #lake volumes change even if no downnode does
+        
+        downnodes=d8Cells(self._data, rerouted)
+        flat=downnodes<0
+        parent=np.full(self._elevation.size, -1, dtype=np.int64)
+        parent[cells]=parents
+        inRegion=region[rerouted]
+        downnodes[flat & inRegion]=parent[rerouted[flat & inRegion]] #lake surfaces drain to their flood parent
+        keep=flat & ~inRegion
+        downnodes[keep]=self._downnode[rerouted[keep]] #flat cells outside the region keep their drainage
+        self._rerouteCells(rerouted, downnodes)
+        relake=np.unique(np.concatenate(relake+[cells]))
+        lakes={outflow: members for members, outflow in self._lakes}
+        for members, outflow in groupLakes(lakeOutflows(self._lakedepth, self._downnode, relake), relake):
+            if outflow in lakes: #the new lake cells drain over the outflow of an unchanged lake
+                members=np.concatenate([lakes[outflow], members])
+            lakes[outflow]=members
+        self._lakes=[(members, outflow) for outflow, members in lakes.items()]
+    
+    
+    def _isEdgeArray(self, cells):
+        """Returns a bool array which is True for the flat indices on the raster edge"""
+        r,c=np.divmod(cells, self.getCols())
+        return (r==0) | (c==0) | (r==self.getRows()-1) | (c==self.getCols()-1)
+    
+    
+    def _floodRegion(self, cells, dem):
+        """Fills the depressions within a region of cells with a priority flood
+        
+        The flood runs on the bounding box of the region, cells outside the 
+        region keep their filled elevation and act as outlets, like the 
+        edge pitflags of the unfilled surface within the region
+        
+        Input Parameter:
+            cells – sorted int array with the flat indices of the region
+            dem – flat float array with the unfilled elevation
+        
+        Returns:
+            a tuple (filled, parents) with the filled elevation and the flat 
+            index of the flood parent of each region cell
+        """
+        rows,cols=np.divmod(cells, self.getCols())
+        r0=max(rows.min()-1, 0)
+        c0=max(cols.min()-1, 0)
+        r1=min(rows.max()+2, self.getRows())
+        c1=min(cols.max()+2, self.getCols())
+        local=(rows-r0)*(c1-c0)+(cols-c0)
+        elevation=self._data[r0:r1,c0:c1].copy()
+        elevation.flat[local]=dem[cells]
+        outlets=np.ones(elevation.shape, dtype=bool)
+        edge=self._isEdgeArray(cells)
+        outlets.flat[local]=False
+        outlets.flat[local[edge]]=d8Cells(dem.reshape(self.getShape()), cells[edge])<0
+        filled,parents=priorityFlood(elevation, outlets)
+        parents=parents.ravel()[local]
+        hasParent=parents>=0
+        parents[hasParent]=(parents[hasParent]//(c1-c0)+r0)*self.getCols()+parents[hasParent]%(c1-c0)+c0
+        return filled.ravel()[local], parents
+    
+    
+    def _regionBoundary(self, cells, filled, islake):
+        """Finds the cells next to a flooded region which the region has to be extended by
+        
+        These are lake cells which could now drain lower through the region 
+        and flat cells which drain into the region, as their drainage could 
+        otherwise run in circles
+        
+        Input Parameter:
+            cells – sorted int array with the flat indices of the region
+            filled – new filled elevation of the region cells
+            islake – flat bool array, True for the cells of the lakes before the change
+        
+        Returns:
+            an int array with flat indices
+        """
+        shape=self.getShape()
+        neighbours=neighbourCells(cells, shape)
+        outside=(neighbours>=0) & ~np.isin(neighbours, cells)
+        lower=outside & islake[neighbours] & (filled[:,np.newaxis]<self._elevation[neighbours])
+        
+        boundary=np.unique(neighbours[outside])
+        down=self._downnode[boundary]
+        boundary=boundary[(down>=0) & np.isin(down, cells)]
+        around=neighbourCells(boundary, shape)
+        heights=np.where(around>=0, self._elevation[around], np.inf)
+        inRegion=np.isin(around, cells)
+        heights[inRegion]=filled[np.searchsorted(cells, around[inRegion])]
+        flat=~(heights.min(axis=1)<self._elevation[boundary])
+        return np.unique(np.r_[neighbours[lower], boundary[flat]])
+    
+    
+    def _rerouteCells(self, cells, downnodes):
+        """Sets new downnodes for some cells and updates the cached flows
+        
+        Only the flows on the old and new downstream paths of the cells whose 
+        downnode changed are recalculated (see FlowEngine.reaccumulateFlow)
+        
+        Input Parameter:
+            cells – int array with flat indices
+            downnodes – int array with the new downnode of each cell, -1 for pitflags
+        """
+        changed=downnodes!=self._downnode[cells]
+        if not changed.any():
+            return
+        cells=cells[changed]
+        downnodes=downnodes[changed]
+        affected=downstreamCells(self._downnode, self._downnode[cells])
+        self._downnode[cells]=downnodes
+        self._pitflag[cells]=downnodes<0
+        affected=np.union1d(affected, downstreamCells(self._downnode, downnodes))
+        
+        self._topology=None
+        self._upstream=None
+        self._labels=None
+        self._catchments=None
+        self._basinCache={}
+        for constRain, flow in self._flowCache.items():
+            rainfall=constRain
+            if constRain is None:
+                rainfall=0. if self._rainfall is None else self._rainfall
+            flow=flow.copy()
+            reaccumulateFlow(flow, self._downnode, rainfall, affected, self.getShape())
+            flow.flags.writeable=False
+            self._flowCache[constRain]=flow
+            
+            
+    def createLake(self, i,j):
+        """Creates a lake at position i,j, see FlowRaster.createLake
+        
+        Input Parameter:
+            i – row of the pitflag (int)
+            j – column of the pitflag (int)
+            
+        Returns:
+            a tuple (cells, outflow), see _growLake
+        """
+        return self._growLake(i*self.getCols()+j)
+    
+    
+    def setLakeDownnodes(self, lake):
+        """Recalculates the downnodes of the lake cells and of the outflow, see FlowRaster.setLakeDownnodes
+        
+        Input Parameter:
+            lake – a (cells, outflow) tuple from createLake
+        """
+        self._drainLake(*lake)
+        
+        
+    def _growLake(self, index):
+        """Creates a lake starting at a pitflag, grows it by always adding the 
+        lowest neighbour until an edge pitflag is reached, and fills the lake 
+        up to its outflow (the highest cell on that path)
+        
+        Input Parameter:
+            index – flat index of the pitflag
+        
+        Returns:
+            a tuple (cells, outflow) – list of flat indices of the lake cells 
+                                       and flat index of the outflow
+        """
+        elevation=self._elevation
+        pitflag=self._pitflag
+        assert pitflag[index]
+        cells=[index]
+        inlake={index}
+        frontier=[] #heap of (elevation, insertion order, index)
+        infrontier=set()
+        order=0
+        current=index
+        while True:
+            for n in self._neighbourIndices(current):
+                if n not in inlake and n not in infrontier:
+                    heapq.heappush(frontier, (elevation[n], order, n))
+                    infrontier.add(n)
+                    order+=1
+            current=heapq.heappop(frontier)[2]
+            infrontier.remove(current)
+            cells.append(current)
+            inlake.add(current)
+            if pitflag[current] and self._isEdge(current): #arrived at an edge pitflag
+                break
+        if self._profile is not None:
+            self._profile.addLake(len(cells), order) #before the lake is cut back to its outflow
+            
+        #outflow is the highest cell on the path (last one when equal)
+        heights=elevation[cells]
+        highest=len(cells)-1-int(np.argmax(heights[::-1]))
+        cells=cells[:highest+1]
+        outflow=cells[highest]
+        
+        surface=self._elevation[outflow]
+        self._lakedepth[cells]+=surface-self._elevation[cells]
+        self._elevation[cells]=surface
+        return (cells, outflow)
+    
+    
+    def _drainLake(self, cells, outflow):
+        """Resets the downnodes of the lake cells, always draining the checked cell 
+        nearest to the outflow first (see FlowEngine.drainLake). Recalculates 
+        the outflow downnode.
+        
+        Input Parameter:
+            cells – list of flat indices of the lake cells
+            outflow – flat index of the lake outflow
+        """
+        drained,downnodes=drainLake(cells, outflow, self.getShape())
+        self._downnode[drained]=downnodes
+        self._pitflag[drained]=False
+        self._setDownnode(outflow, self._outflowDownnode(outflow))
+        self._invalidateFlows()
+    
+    
+    def _outflowDownnode(self, outflow):
+        """Returns the downnode index of a lake outflow, see FlowRaster._outflowDownnode
+        
+        Input Parameter:
+            outflow – flat index of the outflow
+        """
+        neighbours=sorted(self._neighbourIndices(outflow), key=self._elevation.__getitem__) #stable, first lowest
+        for neighbour in neighbours:
+            index=neighbour
+            while index>=0 and index!=outflow:
+                index=self._downnode[index]
+            if index<0: #reaches a pitflag without passing the outflow
+                return neighbour
+        return -1
+        
+        
+    def _getDownnodeArray(self):
+        """Returns the flat downnode index array, -1 for pitflags"""
+        return self._downnode
+    
+    
+    def _getRainfallArray(self, constRain=None):
+        """Returns a flat float array with the rain per cell
+        
+        Input Parameter:
+            constRain – constant rain per cell, if None the added rainfall is used (0 if there is none)
+        """
+        if constRain is not None:
+            return np.full(self._elevation.size, constRain, dtype=float)
+        if self._rainfall is None:
+            return np.zeros(self._elevation.size)
+        return self._rainfall
+    
+    
+    def _getElevationArray(self):
+        """Returns the flat elevation array"""
+        return self._elevation
+    
+    
+    def _getLakeDepthArray(self):
+        """Returns the flat lake depth array"""
+        return self._lakedepth
+    
+    
+    def addRainfall(self, rainfall):
+        """Adds rainfall to the Raster
+        
+        Input Parameter:
+            rainfall – numpy.ndarray containing rainfall for each cell
+                        expected to have the same size an shape as 
+                        the raster data
+        """
+        assert rainfall.shape[0]==self.getRows() #assert that same shape
+        assert rainfall.shape[1]==self.getCols() #assert that same shape
+        self._rainfall=np.array(rainfall, dtype=float).ravel()
+        self._invalidateFlows(rainfallOnly=True)
+        
+        
+
 class Lake():
     """A class representing lakes
     Helper for the calculation of lakes
     
+    Lake nodes and neighbours are kept in sets, so membership tests are O(1). 
+    The neighbours are also kept in a min-heap keyed by elevation, so the 
+    lowest neighbour is found in O(log n) however big the lake grows.
+    
     """
     
     def __init__(self, startNode):
@@ -513,8 +1829,11 @@ class Lake():
         
         """
         assert startNode.getPitFlag()
-        self._neighbours = []
-        self._nodes = []
+        self._neighbours = set() #current neighbours of the lake
+        self._frontier = [] #heap of (elevation, insertion order, node), may hold removed neighbours
+        self._order = 0 #insertion counter, keeps the first added of equally low neighbours first
+        self._nodes = [] #lake nodes in the order they were added
+        self._members = set() #lake nodes, for membership tests
         self.addNode(startNode)
         self._outflow=None
 
@@ -528,19 +1847,22 @@ class Lake():
         """
         for node in neighbours:
             #check if already in lake or already in neighbours
-            if node not in self._neighbours and node not in self._nodes:
-                self._neighbours.append(node)
+            if node not in self._neighbours and node not in self._members:
+                self._neighbours.add(node)
+                heapq.heappush(self._frontier, (node.getElevation(), self._order, node))
+                self._order+=1
 
         
         
     def removeNeighbour(self, node):
         """Removes neighbours from self._neighbours
         
+        The node stays in the heap and is skipped by lowestNeighbour()
+        
         Input Parameter:
             node – a FlowNode object which should be removed
         """
-        if node in self._neighbours:
-            self._neighbours.remove(node)
+        self._neighbours.discard(node)
 
             
     def lowestNeighbour(self):
@@ -549,13 +1871,12 @@ class Lake():
         Returns:
             lownode - the node representing the lowest neighbour, a FlowNode object
         """
-        lownode=None
-        
-        for neighbour in self._neighbours:
-            if lownode==None or neighbour.getElevation() < lownode.getElevation():
-                lownode=neighbour
+        while self._frontier and self._frontier[0][2] not in self._neighbours:
+            heapq.heappop(self._frontier) #drop neighbours removed since they were added
         
-        return lownode
+        if not self._frontier:
+            return None
+        return self._frontier[0][2]
     
         
         
@@ -565,12 +1886,10 @@ class Lake():
         Input Parameter:
             node – to be added, a FlowNode object
         """
-        assert node not in self._nodes
+        assert node not in self._members
         self.removeNeighbour(node)
         self._nodes.append(node)
-        
-        for node in self._nodes:
-            assert node not in self._neighbours
+        self._members.add(node)
         
     
     def isLake(self, node):
@@ -579,7 +1898,7 @@ class Lake():
         Input Parameter:
             node – a FlowNode object
         """
-        return node in self._nodes
+        return node in self._members
     
 
                 
@@ -594,6 +1913,7 @@ class Lake():
 
         self._outflow=self._nodes[highest]
         self._nodes=self._nodes[:highest+1]
+        self._members=set(self._nodes)
         
         for node in self._nodes:
             node.fill(self._outflow.getElevation())
@@ -620,6 +1940,31 @@ class Lake():
 
     
     
+class FilledLake(Lake):
+    """A lake filled at once by the priority flood, see FlowRaster.fillDepressions
+    
+    Has the nodes and the outflow of a finalised Lake, so all lakes of a 
+    FlowRaster can be used alike, but it is not grown from a pitflag
+    
+    Inherits from Lake
+    """
+    
+    def __init__(self, nodes, outflow):
+        """Constructor for FilledLake
+        
+        Input Parameter:
+            nodes – the lake nodes, already filled up to the lake surface
+            outflow – the node the lake drains through, a FlowNode object
+        
+        """
+        self._neighbours = set()
+        self._frontier = []
+        self._order = 0
+        self._nodes = list(nodes)+[outflow] #like a finalised Lake, the outflow comes last
+        self._members = set(self._nodes)
+        self._outflow = outflow
+    
+    
 class FlowExtractor():
     """A class responsible for extracting flow values
     
@@ -634,6 +1979,10 @@ class FlowExtractor():
         """
         self._constantRain=rain
     
+    def getConstantRain(self):
+        """Returns the constant rain per cell, None if the rainfall per cell is used"""
+        return self._constantRain
+    
     def getValue(self, node):
         """extracts the flow value of a node
         
@@ -642,6 +1991,17 @@ class FlowExtractor():
         """
         return node.getFlow(self._constantRain)
     
+    def getGrid(self, flowRaster):
+        """extracts the flow of all cells at once
+        
+        Returns a writable copy, FlowRaster.getFlowGrid returns the cached 
+        read-only grid without copying
+        
+        Input Parameter:
+            flowRaster – A FlowRaster class object
+        """
+        return _gridCopy(flowRaster.getFlowGrid(self._constantRain), flowRaster.getShape())
+    
     
 class LakeDepthExtractor():
     """A class responsible for extracting lake depth values
@@ -657,6 +2017,14 @@ class LakeDepthExtractor():
         """
         return node.getLakeDepth()
     
+    def getGrid(self, flowRaster):
+        """extracts the lake depth of all cells at once
+        
+        Input Parameter:
+            flowRaster – A FlowRaster class object
+        """
+        return _gridCopy(flowRaster._getLakeDepthArray(), flowRaster.getShape())
+    
     
 class ElevationExtractor():
     """A class responsible for extracting elevation values
@@ -671,6 +2039,14 @@ class ElevationExtractor():
         """
         return node.getElevation()
     
+    def getGrid(self, flowRaster):
+        """extracts the elevation of all cells at once
+        
+        Input Parameter:
+            flowRaster – A FlowRaster class object
+        """
+        return _gridCopy(flowRaster._getElevationArray(), flowRaster.getShape())
+    
     
 class RainfallExtractor():
     """A class responsible for extracting rainfall values
@@ -684,4 +2060,20 @@ class RainfallExtractor():
             node – A FlowNode class object
         """
         return node.getRainfall()
+    
+    def getGrid(self, flowRaster):
+        """extracts the rainfall (0 where none was added) of all cells at once
+        
+        Input Parameter:
+            flowRaster – A FlowRaster class object
+        """
+        return _gridCopy(flowRaster._getRainfallArray(), flowRaster.getShape())
 
+
+def _gridCopy(values, shape):
+    """Returns a copy of a flat array of the raster in its 2d shape
+    
+    ArrayFlowRaster changes its arrays in place, e.g. when lakes are filled, 
+    so grids are snapshots like the grids extracted node by node
+    """
+    return np.array(values).reshape(shape)
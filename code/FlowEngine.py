@@ -0,0 +1,760 @@
+# -*- coding: utf-8 -*-
+"""
+Whole-grid numpy kernels used by FlowRaster and ArrayFlowRaster
+
+Cells are addressed by their flat index (row*cols+col), a downnode
+index of -1 marks a pitflag.
+"""
+import collections
+import heapq
+
+import numpy as np
+
+#row and column offsets of the eight neighbours, same order as FlowRaster
+NEIGHBOUR_OFFSETS=np.array([[1,-1],[1,0],[1,1],[0,-1],[0,1],[-1,-1],[-1,0],[-1,1]])
+
+
+def d8Downnodes(elevation):
+    """Calculates the D8 downnode of every cell in one pass
+
+    The elevation is padded with a ring of +inf, so the eight shifted views
+    of the padded grid all have the shape of the raster. The downnode of a
+    cell is its lowest neighbour (the first one in NEIGHBOUR_OFFSETS order
+    when several are equally low) if that neighbour is lower than the cell.
+
+    Input Parameter:
+        elevation – 2d numpy array with the elevation of each cell
+
+    Returns:
+        a tuple (downnodes, pitflags)
+            downnodes: 2d int array with the flat index of the downnode, -1 for pitflags
+            pitflags: 2d bool array, True where a cell has no downnode
+    """
+    elevation=np.asarray(elevation, dtype=float)
+    rows,cols=elevation.shape
+    padded=np.full((rows+2, cols+2), np.inf)
+    padded[1:-1,1:-1]=elevation
+
+    shifted=np.empty((8, rows, cols))
+    for k,(dr,dc) in enumerate(NEIGHBOUR_OFFSETS):
+        shifted[k]=padded[1+dr:1+dr+rows, 1+dc:1+dc+cols]
+    lowest=np.argmin(shifted, axis=0) #first minimum, like the strict < of lowestNeighbour
+    lowestElevation=np.take_along_axis(shifted, lowest[np.newaxis], axis=0)[0]
+
+    pitflags=~(lowestElevation<elevation)
+    r,c=np.indices((rows, cols))
+    downnodes=(r+NEIGHBOUR_OFFSETS[lowest,0])*cols+(c+NEIGHBOUR_OFFSETS[lowest,1])
+    downnodes[pitflags]=-1
+    return downnodes, pitflags
+
+
+def topologicalLevels(downnodes):
+    """Orders the cells of a flow network so that every cell comes before its downnode
+
+    Cells are grouped into levels: the first level holds all cells without
+    upnodes, each further level the cells whose upnodes are all in earlier
+    levels. A level in which several cells drain to the same downnode is
+    split up, so no two cells of a level share a downnode and a level can
+    pass its flow on with a plain vectorised add. The work per level is
+    proportional to its size, so the whole ordering is linear in the number
+    of cells (plus sorting within the levels).
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+
+    Returns:
+        levels – a list of int arrays with the flat indices of each level
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    n=downnodes.size
+    indegree=np.bincount(downnodes[downnodes>=0], minlength=n)
+    current=np.flatnonzero(indegree==0)
+    levels=[]
+    ordered=0
+    while current.size:
+        levels.extend(_splitSharedDownnodes(current, downnodes[current]))
+        ordered+=current.size
+        down=downnodes[current]
+        down,counts=np.unique(down[down>=0], return_counts=True)
+        indegree[down]-=counts
+        current=down[indegree[down]==0]
+    if ordered<n:
+        raise ValueError("flow network contains a cycle")
+    return levels
+
+
+def _splitSharedDownnodes(level, down):
+    """Splits a level into parts in which no two cells share a downnode
+
+    The k-th cell draining to a downnode goes to the k-th part, pitflags
+    stay in the first part.
+    """
+    order=np.argsort(down, kind="stable")
+    down=down[order]
+    position=np.arange(down.size)
+    first=np.r_[True, down[1:]!=down[:-1]] | (down<0)
+    rank=position-np.maximum.accumulate(np.where(first, position, 0)) #how many cells before share the downnode
+    if not rank.any():
+        return [level]
+    level=level[order]
+    return [level[rank==r] for r in range(rank.max()+1)]
+
+
+def accumulateFlow(downnodes, rainfall, levels=None, out=None):
+    """Sums the rainfall of every cell down the flow network
+
+    The flow of a cell is its own rainfall plus the flow of all its upnodes.
+    The levels are processed in order and each level passes its flow on to
+    the downnodes in one vectorised step.
+
+    Several rain scenarios can be accumulated in the same sweep by passing
+    a stack of rainfall grids, e.g. of shape (k, rows, cols). The stack is
+    then kept with one row per cell, so each cell passes on k contiguous values.
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        rainfall – float array with the rain per cell (same size as downnodes), 
+                   or a stack of them (size k times the size of downnodes)
+        levels – optional result of topologicalLevels(downnodes)
+        out – optional float array of the shape of rainfall to write the flow into, 
+              allows repeated calls to reuse one buffer
+
+    Returns:
+        flow – float array with the accumulated flow per cell, same shape as rainfall
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    if levels is None:
+        levels=topologicalLevels(downnodes)
+    if out is None:
+        flow=np.array(rainfall, dtype=float)
+    else:
+        flow=out
+        np.copyto(flow, np.reshape(rainfall, flow.shape))
+    stack=flow.size!=downnodes.size
+    if stack:
+        flat=flow.reshape(-1, downnodes.size).T.copy()
+    else:
+        flat=flow.reshape(-1)
+    for level in levels:
+        down=downnodes[level]
+        hasDown=down>=0
+        flat[down[hasDown]]+=flat[level[hasDown]] #no two cells of a level share a downnode
+    if stack:
+        flow[...]=flat.T.reshape(flow.shape)
+    return flow
+
+
+def priorityFlood(elevation, outlets=None, labels=False):
+    """Fills all depressions of a DEM in one pass (priority flood)
+
+    All outlet cells are put on a priority queue with their elevation. The
+    lowest cell is taken from the queue and each of its unvisited neighbours
+    is raised to at least that level and queued. Cells that get raised (or
+    lie on a flat) go to a plain FIFO queue instead of the heap, as they
+    are already at the current level. Every cell is visited once, so the
+    whole fill costs O(n log n).
+
+    The cell a neighbour was reached from is recorded as its parent. Parents
+    always have the same or a lower filled elevation and lead back to an
+    outlet, which gives a drainage direction on the flat lake surfaces.
+
+    With labels, every outlet starts its own watershed label, which is
+    passed on to every cell the flood reaches from it. Where two labels
+    meet, the pair is recorded as a spill edge with the higher filled
+    elevation of the two cells. For a tile of TiledFlowRaster, with the
+    tile perimeter as outlets, these edges and the edges across tile
+    borders form the spill graph solved by solveSpillGraph.
+
+    Input Parameter:
+        elevation – 2d numpy array with the elevation of each cell
+        outlets – optional 2d bool array marking the cells water can leave the 
+                  raster through, all edge cells if None or if no cell is marked
+        labels – if True, the watershed labels and spill edges are returned as well
+
+    Returns:
+        a tuple (filled, parents), with labels a tuple (filled, parents, labels, edges)
+            filled: 2d float array with the filled elevation of each cell
+            parents: 2d int array with the flat index of the parent, -1 for outlets
+            labels: 2d int array with the flat index of the outlet each cell drains to
+            edges: a tuple (labelA, labelB, weight, cellA, cellB) of arrays, the lowest spill
+                   edge for each pair of adjacent labels and the two cells it runs between
+    """
+    elevation=np.asarray(elevation, dtype=float)
+    rows,cols=elevation.shape
+    width=cols+2 #cells are addressed in a grid padded by one cell, so no bounds checks are needed
+    padded=np.zeros((rows+2, width))
+    padded[1:-1,1:-1]=elevation
+    filled=padded.ravel().tolist()
+    visited=np.ones((rows+2, width), dtype=bool)
+    visited[1:-1,1:-1]=False
+    visited=visited.ravel().tolist()
+    parents=[-1]*len(filled)
+    watersheds=[-1]*len(filled)
+    offsets=[int(dr*width+dc) for dr,dc in NEIGHBOUR_OFFSETS]
+
+    if outlets is None or not np.any(outlets):
+        outlets=np.zeros((rows, cols), dtype=bool)
+        outlets[[0,-1],:]=True
+        outlets[:,[0,-1]]=True
+    heap=[]
+    order=0
+    for r,c in zip(*np.nonzero(outlets)): #row by row
+        i=int((r+1)*width+c+1)
+        visited[i]=True
+        watersheds[i]=i
+        heap.append((filled[i], order, i))
+        order+=1
+    heapq.heapify(heap)
+    pit=collections.deque()
+    edges=[]
+
+    while heap or pit:
+        if pit:
+            i=pit.popleft()
+        else:
+            i=heapq.heappop(heap)[2]
+        level=filled[i]
+        label=watersheds[i]
+        for off in offsets:
+            j=i+off
+            if visited[j]:
+                if labels and watersheds[j]!=label and watersheds[j]>=0: #two watersheds meet
+                    edges.append((label, watersheds[j], max(level, filled[j]), i, j))
+                continue
+            visited[j]=True
+            parents[j]=i
+            watersheds[j]=label
+            if filled[j]<=level:
+                filled[j]=level
+                pit.append(j)
+            else:
+                heapq.heappush(heap, (filled[j], order, j))
+                order+=1
+
+    filled=np.array(filled).reshape(rows+2, width)[1:-1,1:-1]
+    parents=_unpad(parents, width, cols).reshape(rows+2, width)[1:-1,1:-1] #to flat index of the raster
+    if not labels:
+        return filled, parents
+    watersheds=_unpad(watersheds, width, cols).reshape(rows+2, width)[1:-1,1:-1]
+    return filled, parents, watersheds, _lowestSpillEdges(edges, width, cols)
+
+
+def _lowestSpillEdges(edges, width, cols):
+    """Keeps the lowest spill edge of each pair of labels, see priorityFlood
+
+    Input Parameter:
+        edges – list of (labelA, labelB, weight, cellA, cellB) tuples with flat indices of the padded grid
+        width – columns of the padded grid
+        cols – columns of the grid
+    """
+    edges=np.array(edges, dtype=float).reshape(-1, 5)
+    a,b,weight=_unpad(edges[:,0], width, cols), _unpad(edges[:,1], width, cols), edges[:,2]
+    cellA,cellB=_unpad(edges[:,3], width, cols), _unpad(edges[:,4], width, cols)
+    swap=a>b #store each pair once, lower label first
+    a,b=np.where(swap, b, a), np.where(swap, a, b)
+    cellA,cellB=np.where(swap, cellB, cellA), np.where(swap, cellA, cellB)
+    order=np.lexsort((weight, b, a)) #lowest weight first within each pair
+    first=np.r_[True, (a[order][1:]!=a[order][:-1]) | (b[order][1:]!=b[order][:-1])] if order.size else np.array([], dtype=bool)
+    keep=order[first]
+    return a[keep], b[keep], weight[keep], cellA[keep], cellB[keep]
+
+
+def floodDownnodes(filled, parents):
+    """Calculates downnodes on a filled DEM
+
+    Cells with a lower neighbour on the filled surface drain with D8, cells on
+    a flat (e.g. a lake surface) drain to their priority flood parent. Only
+    edge cells without a lower neighbour stay pitflags.
+
+    Input Parameter:
+        filled – 2d float array, filled elevation from priorityFlood
+        parents – 2d int array, parents from priorityFlood
+
+    Returns:
+        a tuple (downnodes, pitflags) like d8Downnodes
+    """
+    downnodes,pitflags=d8Downnodes(filled)
+    flat=pitflags & (parents>=0)
+    downnodes[flat]=parents[flat]
+    pitflags=downnodes<0
+    return downnodes, pitflags
+
+
+def lakeOutflows(lakedepth, downnodes, cells=None):
+    """Finds the outflow of every lake cell
+
+    Lake cells are cells with a depth above zero. The outflow of a lake cell
+    is the first cell that is not part of a lake on its way downstream, found
+    for all cells at once by pointer jumping along the downnodes, which
+    needs a logarithmic number of vectorised steps.
+
+    If only the outflows of some cells are wanted, these cells are walked 
+    down step by step instead, which only touches the cells on their paths.
+
+    Input Parameter:
+        lakedepth – float array with the lake depth per cell
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        cells – optional int array with the flat indices of the cells wanted
+
+    Returns:
+        outflows – flat int array with the flat index of the outflow, -1 for cells which are no lake
+                   (one entry per cell of cells if given)
+    """
+    islake=np.asarray(lakedepth).ravel()>0
+    downnodes=np.asarray(downnodes).ravel()
+    if cells is not None:
+        cells=np.asarray(cells, dtype=np.int64).ravel()
+        outflows=np.where(islake[cells], cells, -1)
+        walking=np.flatnonzero(outflows>=0)
+        while walking.size:
+            outflows[walking]=downnodes[outflows[walking]]
+            walking=walking[(outflows[walking]>=0) & islake[outflows[walking]]]
+        return outflows
+    jump=np.arange(downnodes.size)
+    jump[islake]=downnodes[islake] #cells which are no lake point to themselves
+    lakecells=np.flatnonzero(islake)
+    while islake[jump[lakecells]].any():
+        jump=jump[jump] #doubles the distance jumped in each step
+    outflows=np.full(downnodes.size, -1, dtype=np.int64)
+    outflows[lakecells]=jump[lakecells]
+    return outflows
+
+
+def groupLakes(outflows, cells=None):
+    """Groups lake cells by their outflow
+
+    Input Parameter:
+        outflows – flat int array from lakeOutflows
+        cells – optional int array with the flat indices the outflows belong to, 
+                if lakeOutflows was only called for some cells
+
+    Returns:
+        lakes – a list of (cells, outflow) tuples, cells is an int array with
+                the flat indices of the lake cells, outflow the flat index of the outflow
+    """
+    outflows=np.asarray(outflows).ravel()
+    if cells is None:
+        cells=np.arange(outflows.size)
+    cells=np.asarray(cells, dtype=np.int64).ravel()
+    order=np.flatnonzero(outflows>=0)
+    order=order[np.argsort(outflows[order], kind="stable")]
+    keys=outflows[order]
+    cells=cells[order]
+    starts=np.flatnonzero(np.r_[True, keys[1:]!=keys[:-1]]) if cells.size else np.array([], dtype=np.int64)
+    return [(group, int(keys[start])) for start, group in zip(starts, np.split(cells, starts[1:]))]
+
+
+def drainLake(cells, outflow, shape):
+    """Calculates downnodes inside a filled lake with gravitation towards the outflow
+
+    Starting at the outflow, the reached lake cell nearest to the outflow is
+    taken next and all unreached lake neighbours of it drain to it. Reached
+    cells are kept in a heap keyed by their squared distance to the outflow
+    (ties in the order they were reached), and membership is tested on a
+    bool mask of the lake's bounding box, padded by one cell so no bounds
+    checks are needed. Each cell is handled once, so a lake costs O(n log n).
+
+    Input Parameter:
+        cells – flat indices of the lake cells (including the outflow)
+        outflow – flat index of the lake outflow
+        shape – (rows, cols) of the raster
+
+    Returns:
+        a tuple (drained, downnodes)
+            drained: int array with the flat indices of the lake cells, in the order they were reached
+            downnodes: int array with the flat index of the downnode of each drained cell
+    """
+    rows,cols=shape
+    cells=np.asarray(cells, dtype=np.int64).ravel()
+    r,c=np.divmod(cells, cols)
+    rmin,cmin=int(r.min())-1, int(c.min())-1
+    width=int(c.max())-cmin+2
+    height=int(r.max())-rmin+2
+    inlake=np.zeros(height*width, dtype=bool)
+    inlake[(r-rmin)*width+(c-cmin)]=True
+    inlake=inlake.tolist()
+    offsets=[int(dr*width+dc) for dr,dc in NEIGHBOUR_OFFSETS]
+
+    ro,co=divmod(int(outflow), cols)
+    start=(ro-rmin)*width+(co-cmin)
+    inlake[start]=False #reached cells are taken out of the mask
+    tocheck=[(0, 0, start)] #heap of (squared distance to outflow, reach order, local index)
+    order=1
+    drained=[]
+    downnodes=[]
+    while tocheck:
+        checknode=heapq.heappop(tocheck)[2]
+        for off in offsets:
+            n=checknode+off
+            if inlake[n]:
+                inlake[n]=False
+                drained.append(n)
+                downnodes.append(checknode)
+                dr,dc=divmod(n, width)
+                dr+=rmin-ro
+                dc+=cmin-co
+                heapq.heappush(tocheck, (dr*dr+dc*dc, order, n))
+                order+=1
+
+    drained=np.array(drained, dtype=np.int64)
+    downnodes=np.array(downnodes, dtype=np.int64)
+    #back to flat indices of the raster
+    drained=(drained//width+rmin)*cols+(drained%width+cmin)
+    downnodes=(downnodes//width+rmin)*cols+(downnodes%width+cmin)
+    return drained, downnodes
+
+
+def solveSpillGraph(labelA, labelB, weight, cellA, cellB, outlets, outletLevels):
+    """Calculates the spill level of every watershed label (a priority flood on the label graph)
+
+    The spill level of a label is the lowest level water in it has to rise
+    to before it can leave through an outlet: the lowest possible maximum
+    edge weight on a path to an outlet label. Labels are taken from a heap
+    in order of their spill level, like Dijkstra's algorithm. The edge a
+    label is reached through is recorded as its exit: the cell water leaves
+    the label through and the cell of the next label it flows into.
+
+    Input Parameter:
+        labelA, labelB, weight, cellA, cellB – arrays of undirected spill edges
+                  between two labels with the cells they run between
+        outlets – array of outlet labels (whose water leaves the raster)
+        outletLevels – array with the elevation of each outlet
+
+    Returns:
+        a tuple (labels, spill, exitFrom, exitTo) of arrays, sorted by label
+            spill: spill level per label, inf for labels that can't drain
+            exitFrom: cell each label drains out of (the outlet itself for outlet labels)
+            exitTo: cell that cell drains to, -1 for outlets
+    """
+    labelA,labelB,outlets=(np.asarray(a, dtype=np.int64).ravel() for a in (labelA, labelB, outlets))
+    labels=np.unique(np.concatenate((labelA, labelB, outlets)))
+    a=np.searchsorted(labels, labelA)
+    b=np.searchsorted(labels, labelB)
+    #every edge in both directions, grouped by the label it starts at
+    source=np.concatenate((a, b))
+    order=np.argsort(source, kind="stable")
+    target=np.concatenate((b, a))[order].tolist()
+    edgeWeight=np.concatenate((weight, weight))[order].tolist()
+    fromCell=np.concatenate((cellB, cellA))[order].tolist() #cell on the side of the target
+    toCell=np.concatenate((cellA, cellB))[order].tolist() #cell on the side of the source
+    starts=np.searchsorted(source[order], np.arange(labels.size+1)).tolist()
+
+    spill=[np.inf]*labels.size
+    exitFrom=[-1]*labels.size
+    exitTo=[-1]*labels.size
+    heap=[]
+    for outlet, level in zip(np.searchsorted(labels, outlets).tolist(), np.asarray(outletLevels, dtype=float).ravel().tolist()):
+        if level<spill[outlet]:
+            spill[outlet]=level
+            exitFrom[outlet]=int(labels[outlet])
+            heapq.heappush(heap, (level, outlet))
+    done=[False]*labels.size
+
+    while heap:
+        level,i=heapq.heappop(heap)
+        if done[i]:
+            continue
+        done[i]=True
+        for e in range(starts[i], starts[i+1]):
+            j=target[e]
+            candidate=max(level, edgeWeight[e])
+            if candidate<spill[j]:
+                spill[j]=candidate
+                exitFrom[j]=fromCell[e]
+                exitTo[j]=toCell[e]
+                heapq.heappush(heap, (candidate, j))
+
+    return labels, np.array(spill), np.array(exitFrom, dtype=np.int64), np.array(exitTo, dtype=np.int64)
+
+
+def drainFlats(labels, sources, flats):
+    """Drains flat cells towards source cells with the same label
+
+    A multi-source breadth-first search from all source cells, which only
+    steps between cells of the same label. Every flat cell it reaches drains
+    to the cell it was reached from, so each flat cell drains towards the
+    nearest source of its label.
+
+    Input Parameter:
+        labels – 2d int array with a label per cell
+        sources – 2d bool array, cells that already drain
+        flats – 2d bool array, cells that need a downnode
+
+    Returns:
+        a tuple (drained, downnodes)
+            drained: int array with the flat indices of the flat cells reached, in the order they were reached
+            downnodes: int array with the flat index of the downnode of each drained cell
+    """
+    rows,cols=labels.shape
+    width=cols+2 #padded by one cell, so no bounds checks are needed
+    padded=np.full((rows+2, width), -1, dtype=np.int64)
+    padded[1:-1,1:-1]=np.where(flats, labels, -1) #only flat cells can be reached
+    reachable=padded.ravel().tolist()
+    padded[1:-1,1:-1]=labels
+    label=padded.ravel().tolist()
+    offsets=[int(dr*width+dc) for dr,dc in NEIGHBOUR_OFFSETS]
+
+    r,c=np.nonzero(sources)
+    tocheck=collections.deque(((r+1)*width+c+1).tolist())
+    drained=[]
+    downnodes=[]
+    while tocheck:
+        i=tocheck.popleft()
+        for off in offsets:
+            j=i+off
+            if reachable[j]>=0 and reachable[j]==label[i]:
+                reachable[j]=-1
+                drained.append(j)
+                downnodes.append(i)
+                tocheck.append(j)
+
+    return _unpad(drained, width, cols), _unpad(downnodes, width, cols)
+
+
+def _unpad(index, width, cols):
+    """Converts flat indices of a grid padded by one cell to flat indices of the grid, -1 stays -1"""
+    index=np.asarray(index, dtype=np.int64)
+    return np.where(index>=0, (index//width-1)*cols+(index%width-1), -1)
+
+
+def basinLabels(downnodes, levels=None):
+    """Labels every cell with the pitflag it finally drains to
+
+    Cells that drain to the same pitflag form a basin, which shares no cells
+    with any other basin. The labels are passed up the network by going
+    through the topological levels backwards, one vectorised step per level.
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        levels – optional result of topologicalLevels(downnodes)
+
+    Returns:
+        labels – flat int array with the flat index of the pitflag each cell drains to
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    if levels is None:
+        levels=topologicalLevels(downnodes)
+    labels=np.arange(downnodes.size)
+    for level in reversed(levels):
+        down=downnodes[level]
+        hasDown=down>=0
+        labels[level[hasDown]]=labels[down[hasDown]]
+    return labels
+
+
+def neighbourCells(cells, shape):
+    """Returns the flat indices of the eight neighbours of some cells
+
+    Input Parameter:
+        cells – int array with flat indices
+        shape – (rows, cols) of the raster
+
+    Returns:
+        neighbours – int array of shape (len(cells), 8) in NEIGHBOUR_OFFSETS order, 
+                     -1 for neighbours outside the raster
+    """
+    rows,cols=shape
+    r,c=np.divmod(np.asarray(cells, dtype=np.int64).ravel(), cols)
+    rr=r[:,np.newaxis]+NEIGHBOUR_OFFSETS[:,0]
+    cc=c[:,np.newaxis]+NEIGHBOUR_OFFSETS[:,1]
+    inside=(rr>-1) & (rr<rows) & (cc>-1) & (cc<cols)
+    return np.where(inside, rr*cols+cc, -1)
+
+
+def d8Cells(elevation, cells):
+    """Calculates the D8 downnode of some cells, exactly like d8Downnodes
+
+    Input Parameter:
+        elevation – 2d numpy array with the elevation of each cell
+        cells – int array with the flat indices of the cells
+
+    Returns:
+        downnodes – int array with the flat index of the downnode of each cell, -1 for pitflags
+    """
+    elevation=np.asarray(elevation, dtype=float)
+    cells=np.asarray(cells, dtype=np.int64).ravel()
+    neighbours=neighbourCells(cells, elevation.shape)
+    heights=np.where(neighbours>=0, elevation.ravel()[neighbours], np.inf) #like the +inf padding of d8Downnodes
+    lowest=np.argmin(heights, axis=1)
+    index=np.arange(cells.size)
+    downnodes=neighbours[index, lowest]
+    downnodes[~(heights[index, lowest]<elevation.ravel()[cells])]=-1
+    return downnodes
+
+
+def upstreamCells(downnodes, cells, shape):
+    """Finds all cells draining through some cells, the cells included
+
+    The network is walked up one ring of upnodes at a time, so only the
+    upstream cells and their neighbours are touched.
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        cells – int array with flat indices
+        shape – (rows, cols) of the raster
+
+    Returns:
+        upstream – sorted int array with flat indices
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    found=np.zeros(downnodes.size, dtype=bool)
+    current=np.unique(np.asarray(cells, dtype=np.int64))
+    found[current]=True
+    upstream=[current]
+    while current.size:
+        neighbours=neighbourCells(current, shape)
+        isUp=(neighbours>=0) & (downnodes[neighbours]==current[:,np.newaxis])
+        current=np.unique(neighbours[isUp])
+        current=current[~found[current]]
+        found[current]=True
+        upstream.append(current)
+    return np.sort(np.concatenate(upstream))
+
+
+def downstreamCells(downnodes, cells):
+    """Finds all cells on the downstream paths of some cells, the cells included
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        cells – int array with flat indices
+
+    Returns:
+        downstream – sorted int array with flat indices
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    found=np.zeros(downnodes.size, dtype=bool)
+    current=np.unique(np.asarray(cells, dtype=np.int64))
+    current=current[current>=0]
+    found[current]=True
+    downstream=[current]
+    while current.size:
+        current=np.unique(downnodes[current])
+        current=current[current>=0]
+        current=current[~found[current]] #paths merge, each cell is only walked once
+        found[current]=True
+        downstream.append(current)
+    return np.sort(np.concatenate(downstream))
+
+
+def connectedCells(mask, cells, shape):
+    """Finds all cells of a mask which are 8-connected to some cells through the mask
+
+    Input Parameter:
+        mask – flat bool array, e.g. the lake cells
+        cells – int array with the flat indices to start from (they do not need to be in the mask)
+        shape – (rows, cols) of the raster
+
+    Returns:
+        connected – sorted int array with the flat indices of the connected mask cells
+    """
+    mask=np.asarray(mask).ravel()
+    found=np.zeros(mask.size, dtype=bool)
+    current=np.unique(np.asarray(cells, dtype=np.int64))
+    current=current[mask[current]]
+    found[current]=True
+    connected=[current]
+    while current.size:
+        neighbours=neighbourCells(current, shape)
+        current=np.unique(neighbours[neighbours>=0])
+        current=current[mask[current] & ~found[current]]
+        found[current]=True
+        connected.append(current)
+    return np.sort(np.concatenate(connected))
+
+
+def reaccumulateFlow(flow, downnodes, rainfall, cells, shape):
+    """Recalculates the flow of some cells after their upstream network changed
+
+    The flow of all other cells has to be up to date. The cells have to be
+    closed downstream, i.e. contain every downnode of a cell in them, which
+    holds for the result of downstreamCells. Inflow from upnodes outside the
+    cells is taken from their current flow.
+
+    Input Parameter:
+        flow – float array with the flow per cell, updated in place
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        rainfall – float array with the rain per cell or a constant
+        cells – sorted int array with the flat indices to recalculate
+        shape – (rows, cols) of the raster
+    """
+    flat=flow.reshape(-1)
+    downnodes=np.asarray(downnodes).ravel()
+    cells=np.asarray(cells, dtype=np.int64)
+    local=np.searchsorted(cells, downnodes[cells]) #position of the downnode within cells
+    local[downnodes[cells]<0]=-1
+    rain=np.broadcast_to(rainfall, flat.shape)[cells] if np.ndim(rainfall) else np.full(cells.size, float(rainfall))
+    
+    neighbours=neighbourCells(cells, shape)
+    inside=np.zeros(neighbours.shape, dtype=bool)
+    valid=neighbours>=0
+    position=np.searchsorted(cells, neighbours[valid])
+    inside[valid]=cells[np.minimum(position, cells.size-1)]==neighbours[valid]
+    inflow=valid & ~inside & (downnodes[neighbours]==cells[:,np.newaxis])
+    rain=rain+np.where(inflow, flat[neighbours], 0.).sum(axis=1)
+    flat[cells]=accumulateFlow(local, rain)
+
+
+def upstreamGraph(downnodes):
+    """Builds the reverse flow graph in compressed sparse row form
+
+    The upnodes of cell i are upnodes[offsets[i]:offsets[i+1]], ordered by
+    their flat index. Both arrays are built in one vectorised pass by
+    sorting the cells by their downnode.
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+
+    Returns:
+        a tuple (offsets, upnodes)
+            offsets: int array with one entry per cell plus one
+            upnodes: int array with the flat indices of the upnodes of all cells
+    """
+    downnodes=np.asarray(downnodes).ravel()
+    hasDown=np.flatnonzero(downnodes>=0)
+    upnodes=hasDown[np.argsort(downnodes[hasDown], kind="stable")]
+    offsets=np.zeros(downnodes.size+1, dtype=np.int64)
+    np.cumsum(np.bincount(downnodes[hasDown], minlength=downnodes.size), out=offsets[1:])
+    return offsets, upnodes
+
+
+def upnodeCells(offsets, upnodes, cells):
+    """Returns the upnodes of some cells from the graph of upstreamGraph
+
+    Input Parameter:
+        offsets, upnodes – result of upstreamGraph
+        cells – int array with flat indices
+
+    Returns:
+        an int array with the upnodes of all cells, cell by cell
+    """
+    cells=np.asarray(cells, dtype=np.int64)
+    starts=offsets[cells]
+    counts=offsets[cells+1]-starts
+    ends=np.cumsum(counts)
+    index=np.arange(ends[-1] if ends.size else 0)+np.repeat(starts-(ends-counts), counts)
+    return upnodes[index]
+
+
+def catchmentCells(offsets, upnodes, cells):
+    """Finds all cells draining through some cells with the graph of upstreamGraph
+
+    The graph is walked up one ring of upnodes at a time, each step reads
+    contiguous slices of the upnode array.
+
+    Input Parameter:
+        offsets, upnodes – result of upstreamGraph
+        cells – int array with flat indices
+
+    Returns:
+        an int array with the flat indices, the given cells first and 
+        every further cell after its downnode
+    """
+    current=np.unique(np.asarray(cells, dtype=np.int64))
+    catchment=[current]
+    while current.size:
+        current=upnodeCells(offsets, upnodes, current)
+        catchment.append(current)
+    catchment=np.concatenate(catchment)
+    if np.asarray(cells).size>1: #a cell can lie upstream of another given cell
+        catchment=catchment[np.sort(np.unique(catchment, return_index=True)[1])]
+    return catchment
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the FlowNode object graph
+
+Builds a FlowRaster (one FlowNode per cell) and reports how many bytes
+the nodes, their upnode storage and coordinates take per cell, measured
+with tracemalloc. For comparison the same graph is built from LegacyFlowNode,
+the node layout before FlowNode used slots. Run as a script to measure
+dem_hack.txt.
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from RasterHandler import readRaster
+from Flow import FlowRaster
+from FlowEngine import d8Downnodes
+
+
+class LegacyFlowNode():
+    """Node layout of FlowNode before __slots__: a __dict__ per node, float
+    coordinates, a pitflag and a list of upnodes, also when it stays empty
+    """
+
+    def __init__(self, x, y, value, rainfall=None):
+        """Constructor for LegacyFlowNode, same attributes as the old FlowNode"""
+        self._x=x*1.
+        self._y=y*1.
+        self._downnode=None
+        self._upnodes=[]
+        self._pitflag=True
+        self._value=value
+        self._rainfall=rainfall
+        self._lakedepth=0
+
+
+    def setDownnode(self, newDownNode):
+        """Sets the downnode and adds the node to its upnodes, like the old FlowNode"""
+        self._pitflag=(newDownNode==None)
+        if (newDownNode!=None):
+            newDownNode._upnodes.append(self)
+        self._downnode=newDownNode
+
+
+def _buildLegacyNodes(raster):
+    """Builds the node graph of the old FlowRaster from LegacyFlowNode objects"""
+    data=raster.getData()
+    nodes=[]
+    for i in range(data.shape[0]):
+        for j in range(data.shape[1]):
+            y=i*raster.getCellsize()+raster.getOrgs()[0]
+            x=j*raster.getCellsize()+raster.getOrgs()[1]
+            nodes.append(LegacyFlowNode(x, y, data[i,j]))
+    nodearray=np.array(nodes)
+    nodearray.shape=data.shape
+    downnodes=d8Downnodes(np.asarray(data, dtype=float))[0].ravel()
+    flat=nodearray.ravel()
+    for index, down in enumerate(downnodes.tolist()):
+        if down>=0:
+            flat[index].setDownnode(flat[down])
+    return nodearray
+
+
+def _measure(build):
+    """Returns the bytes allocated and the seconds taken by build()"""
+    tracemalloc.start()
+    start=time.perf_counter()
+    result=build()
+    seconds=time.perf_counter()-start
+    allocated=tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return allocated, seconds
+
+
+def nodeMemory(fileName):
+    """Measures the memory of the object graph of a FlowRaster, before and after the compact FlowNode
+
+    Input Parameter:
+        fileName – path of an ascii raster
+
+    Returns:
+        a dictionary with
+            cells: number of cells
+            bytesPerNode: memory allocated while building the FlowRaster per cell
+            seconds: time to build the FlowRaster
+            legacyBytesPerNode: memory allocated per cell by the same graph of LegacyFlowNode objects
+            legacySeconds: time to build the graph of LegacyFlowNode objects
+    """
+    raster=readRaster(fileName)
+    cells=raster.getData().size
+    allocated,seconds=_measure(lambda: FlowRaster(raster))
+    legacyAllocated,legacySeconds=_measure(lambda: _buildLegacyNodes(raster))
+    return {"cells": cells, "bytesPerNode": allocated/cells, "seconds": seconds,
+            "legacyBytesPerNode": legacyAllocated/cells, "legacySeconds": legacySeconds}
+
+
+if __name__=="__main__":
+    fileName=sys.argv[1] if len(sys.argv)>1 else 'ascifiles/dem_hack.txt'
+    result=nodeMemory(fileName)
+    print("{cells} cells".format(**result))
+    print("before: {legacyBytesPerNode:.1f} bytes per node, built in {legacySeconds:.2f}s".format(**result))
+    print("after:  {bytesPerNode:.1f} bytes per node, built in {seconds:.2f}s".format(**result))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel flow accumulation over independent drainage basins
+
+Every cell drains to exactly one pitflag, so the cells draining to the
+same pitflag (a basin) can be accumulated independently of all others.
+The basins are split into chunks of about the same number of cells and
+handed to a process pool. The arrays are passed through shared memory,
+so the workers neither pickle nor copy the grid.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from FlowEngine import topologicalLevels, accumulateFlow, basinLabels
+
+
+def parallelAccumulateFlow(downnodes, rainfall, levels=None, workers=None, chunksPerWorker=4):
+    """Accumulates the flow of every cell, one basin per task in a process pool
+
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        rainfall – float array with the rain per cell (same size as downnodes)
+        levels – optional result of topologicalLevels(downnodes)
+        workers – number of worker processes, os.cpu_count() if None, 
+                  1 runs everything in this process
+        chunksPerWorker – the basins are split into about workers*chunksPerWorker 
+                          chunks, so one big basin doesn't leave the other workers idle
+
+    Returns:
+        a tuple (flow, basins)
+            flow: float array with the accumulated flow per cell, same shape as rainfall
+            basins: a dictionary of arrays with one entry per basin, sorted by outlet
+                outlet: flat index of the pitflag the basin drains to
+                cells: number of cells in the basin
+                rainfall: total rain on the basin
+                maxflow: maximum flow within the basin
+                maxcell: flat index of the cell with the maximum flow
+                outflow: flow at the outlet, equal to the rainfall of the basin
+    """
+    shape=np.shape(rainfall)
+    downnodes=np.asarray(downnodes, dtype=np.int64).ravel()
+    rainfall=np.asarray(rainfall, dtype=float).ravel()
+    if workers is None:
+        workers=os.cpu_count() or 1
+    labels=basinLabels(downnodes, levels)
+    order=np.argsort(labels, kind="stable") #cells grouped by basin, by flat index within a basin
+    starts=np.flatnonzero(np.r_[True, labels[order][1:]!=labels[order][:-1]]) #first cell of each basin in order
+    chunks=_splitBasins(starts, order.size, workers*chunksPerWorker)
+
+    if workers==1:
+        flow=np.empty(order.size)
+        results=[_accumulateBasins(downnodes, rainfall, order, labels[order], flow, start, end) for start, end in chunks]
+    else:
+        arrays={"downnodes": downnodes, "rainfall": rainfall, "order": order, "labels": labels[order], "flow": np.empty(order.size)}
+        blocks={}
+        try:
+            for name, array in arrays.items():
+                blocks[name]=shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=blocks[name].buf)[:]=array
+            spec={name: (blocks[name].name, array.shape, array.dtype.str) for name, array in arrays.items()}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results=list(pool.map(_basinWorker, [(spec, start, end) for start, end in chunks]))
+            flow=np.ndarray(order.size, dtype=float, buffer=blocks["flow"].buf).copy()
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+    basins={key: np.concatenate([result[key] for result in results]) for key in results[0]} if results else {}
+    return flow.reshape(shape), basins
+
+
+def _splitBasins(starts, size, count):
+    """Splits the basins into about count chunks of similar size
+    
+    Input Parameter:
+        starts – int array, position of the first cell of each basin
+        size – total number of cells
+        count – number of chunks wanted
+    
+    Returns:
+        a list of (start, end) tuples, positions of the first and behind the last cell of a chunk
+    """
+    bounds=np.searchsorted(starts, np.linspace(0, size, count+1)[1:-1]) #first basin starting at or after each cut
+    bounds=np.unique(np.r_[0, bounds, starts.size])
+    edges=np.r_[starts, size][bounds]
+    return [(int(start), int(end)) for start, end in zip(edges[:-1], edges[1:]) if end>start]
+
+
+def _basinWorker(task):
+    """Process pool entry point, attaches the shared arrays and accumulates a chunk of basins"""
+    spec,start,end=task
+    blocks={name: shared_memory.SharedMemory(name=blockName) for name, (blockName, shape, dtype) in spec.items()}
+    arrays={name: np.ndarray(spec[name][1], dtype=spec[name][2], buffer=blocks[name].buf) for name in spec}
+    try:
+        return _accumulateBasins(arrays["downnodes"], arrays["rainfall"], arrays["order"], arrays["labels"], arrays["flow"], start, end)
+    finally:
+        del arrays #the shared blocks can only be closed when no array uses them
+        for block in blocks.values():
+            block.close()
+
+
+def _accumulateBasins(downnodes, rainfall, order, labels, flow, start, end):
+    """Accumulates the flow of the basins in order[start:end] and writes it into flow
+    
+    Input Parameter:
+        downnodes, rainfall – flat arrays of the whole raster
+        order – flat indices of all cells, grouped by basin
+        labels – basin label of each cell in order
+        flow – flat output array of the whole raster
+        start, end – the chunk, starts at the first cell of a basin and ends behind the last cell of one
+    
+    Returns:
+        the basin statistics of the chunk, see parallelAccumulateFlow
+    """
+    cells=order[start:end]
+    sortedCells=np.sort(cells)
+    position=np.argsort(cells)
+    down=downnodes[cells]
+    hasDown=down>=0
+    localDown=np.full(cells.size, -1, dtype=np.int64)
+    localDown[hasDown]=position[np.searchsorted(sortedCells, down[hasDown])] #downnodes never leave the basin
+    rain=rainfall[cells]
+    chunkFlow=accumulateFlow(localDown, rain, topologicalLevels(localDown))
+    flow[cells]=chunkFlow
+
+    outlets=labels[start:end]
+    basinStarts=np.flatnonzero(np.r_[True, outlets[1:]!=outlets[:-1]])
+    counts=np.diff(np.r_[basinStarts, cells.size])
+    maxflow=np.maximum.reduceat(chunkFlow, basinStarts)
+    atMax=np.flatnonzero(chunkFlow==np.repeat(maxflow, counts))
+    firstMax=atMax[np.unique(np.searchsorted(basinStarts, atMax, side="right")-1, return_index=True)[1]]
+    outlet=outlets[basinStarts]
+    return {"outlet": outlet,
+            "cells": counts,
+            "rainfall": np.add.reduceat(rain, basinStarts),
+            "maxflow": maxflow,
+            "maxcell": cells[firstMax],
+            "outflow": chunkFlow[position[np.searchsorted(sortedCells, outlet)]]}
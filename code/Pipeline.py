@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch run of the flow pipeline
+
+Runs the steps of Driver.calculateFlowsAndPlot on a DEM and a rainfall
+raster without plotting: resample the DEM, calculate the flow network,
+the flows with constant and with variable rainfall, the lakes and the flow
+statistics. The requested grids are written as ascii rasters and the
+statistics as JSON into the output directory. Nothing runs at import time
+and no plotting library is imported.
+
+The exit status is 0 if the total outflow equals the total rainfall
+(the mass-balance check of the Driver), 1 if it does not.
+
+Usage:
+    python Pipeline.py DEM RAIN [--factor 10] [--outputs flow lakedepth statistics]
+                       [--output-dir results] [--class array] [--engine path] [--profile]
+"""
+import argparse
+import json
+import os
+import sys
+
+import Flow
+from Raster import Raster
+from RasterHandler import readRaster, writeRaster
+
+RASTER_CLASSES={"array": Flow.ArrayFlowRaster, "object": Flow.FlowRaster}
+#grids written as ascii rasters, by output name
+GRIDS=("constantflow", "rainflow", "flow", "lakedepth", "elevation", "watersheds")
+OUTPUTS=GRIDS+("statistics",)
+
+
+def calculateFlows(elevation, rain, resampleF, rasterClass=Flow.ArrayFlowRaster, engine="path", outputs=OUTPUTS, profile=False):
+    """Calculates all the flows, like Driver.calculateFlowsAndPlot without the plots
+
+    Input Parameter:
+        elevation – a Raster class object containing elevation
+        rain – a Raster class object containing rainfall, same shape as the resampled elevation
+        resampleF – an Integer
+        rasterClass – FlowRaster or ArrayFlowRaster
+        engine – lake engine passed to calculateLakes
+        outputs – names of the grids to return, see GRIDS
+        profile – if True, the stages are profiled (see FlowRaster.enableProfiling)
+
+    Returns:
+        a tuple (flowraster, grids, statistics)
+            flowraster: the FlowRaster with lakes
+            grids: a dictionary with a 2d array for each requested output in GRIDS
+            statistics: the dictionary of FlowRaster.getFlowStatistics()
+    """
+    resampledElevations=elevation.createWithIncreasedCellsize(resampleF)
+    if rain.getShape()!=resampledElevations.getShape():
+        raise ValueError("rainfall has shape {}, the resampled elevation {}".format(rain.getShape(), resampledElevations.getShape()))
+
+    grids={}
+    fr=rasterClass(resampledElevations, profile=profile) #step 1, the flow network
+    if "constantflow" in outputs: #step 2, constant rain
+        grids["constantflow"]=fr.extractValues(Flow.FlowExtractor(1))
+    fr.addRainfall(rain.getData()) #step 3, variable rainfall
+    if "rainflow" in outputs:
+        grids["rainflow"]=fr.extractValues(Flow.FlowExtractor())
+
+    fr.calculateLakes(engine) #step 4, lakes
+    if "flow" in outputs:
+        grids["flow"]=fr.extractValues(Flow.FlowExtractor())
+    if "lakedepth" in outputs:
+        grids["lakedepth"]=fr.extractValues(Flow.LakeDepthExtractor())
+    if "elevation" in outputs:
+        grids["elevation"]=fr.extractValues(Flow.ElevationExtractor())
+    if "watersheds" in outputs:
+        grids["watersheds"]=fr.getWatershedLabels()
+    return fr, grids, fr.getFlowStatistics() #step 5, all from the cached flow grid
+
+
+def isBalanced(statistics, decimals=2):
+    """Returns True if the total outflow equals the total rainfall, both rounded like in the Driver"""
+    return round(statistics["totalOutflow"], decimals)==round(statistics["totalRainfall"], decimals)
+
+
+def writeOutputs(directory, flowraster, grids, statistics, balanced):
+    """Writes the grids as ascii rasters and the statistics as JSON
+
+    Input Parameter:
+        directory – output directory, created if missing
+        flowraster – the FlowRaster the grids belong to, gives origin and cell size
+        grids – dictionary of 2d arrays by output name, written to name.asc
+        statistics – dictionary of FlowRaster.getFlowStatistics(), written to statistics.json, None to skip
+        balanced – result of the mass-balance check, added to the statistics
+
+    Returns:
+        list of the paths written
+    """
+    os.makedirs(directory, exist_ok=True)
+    written=[]
+    for name, grid in grids.items():
+        fileName=os.path.join(directory, "{}.asc".format(name))
+        writeRaster(fileName, Raster(grid, flowraster.getOrgs()[0], flowraster.getOrgs()[1], flowraster.getCellsize()))
+        written.append(fileName)
+    if statistics is not None:
+        fileName=os.path.join(directory, "statistics.json")
+        report={key: value.tolist() if hasattr(value, "tolist") else value for key, value in statistics.items()}
+        report["balanced"]=balanced
+        with open(fileName, 'w') as myFile:
+            json.dump(report, myFile, indent=2)
+        written.append(fileName)
+    return written
+
+
+def main(argv=None):
+    """Runs the pipeline from the command line
+
+    Returns:
+        the exit status, 0 if the mass-balance check passed, 1 if not
+    """
+    parser=argparse.ArgumentParser(description="Headless batch run of the flow pipeline")
+    parser.add_argument("dem", help="ascii raster with the elevation")
+    parser.add_argument("rain", help="ascii raster with the rainfall, same shape as the resampled elevation")
+    parser.add_argument("--factor", type=int, default=1, help="resample factor of the elevation")
+    parser.add_argument("--outputs", nargs="*", default=["flow", "lakedepth", "statistics"], choices=OUTPUTS,
+                        help="grids and reports to write")
+    parser.add_argument("--output-dir", default=".", help="directory for the outputs")
+    parser.add_argument("--class", dest="rasterClass", default="array", choices=sorted(RASTER_CLASSES))
+    parser.add_argument("--engine", default="path", choices=["path", "priorityflood"], help="lake engine")
+    parser.add_argument("--no-cache", action="store_true", help="parse the inputs without the binary sidecars")
+    parser.add_argument("--profile", action="store_true", help="print the time of every stage to standard error")
+    args=parser.parse_args(argv)
+
+    elevation=readRaster(args.dem, cache=not args.no_cache)
+    rain=readRaster(args.rain, cache=not args.no_cache)
+    if elevation is None or rain is None:
+        parser.error("could not read the input rasters")
+    try:
+        fr,grids,statistics=calculateFlows(elevation, rain, args.factor, RASTER_CLASSES[args.rasterClass],
+                                           args.engine, args.outputs, args.profile)
+    except ValueError as error:
+        parser.error(str(error))
+
+    balanced=isBalanced(statistics)
+    writeOutputs(args.output_dir, fr, grids, statistics if "statistics" in args.outputs else None, balanced)
+    print("Maximum Flow: {} mm, at cell ({}, {})".format(round(statistics["maxflow"], 3), *statistics["maxcell"]))
+    print("Total rainfall: {}, total outflow: {}, mass balance {}".format(
+          statistics["totalRainfall"], statistics["totalOutflow"], "passed" if balanced else "FAILED"))
+    if args.profile:
+        print(fr.getProfile(), file=sys.stderr)
+    return 0 if balanced else 1
+
+
+if __name__=="__main__":
+    sys.exit(main())
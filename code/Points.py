@@ -10,6 +10,8 @@ import math
 class Point2D(object):
     '''A class to represent 2-D points'''
 
+    __slots__=("_x","_y") #no per instance __dict__
+
     def __init__(self,x,y):
         """Constructor for Point2D
         
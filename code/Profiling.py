@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in stage timings and counters for FlowRaster runs
+
+FlowRaster.enableProfiling() wraps the stage methods of one raster
+instance with timing and counting wrappers. The classes are not changed,
+so rasters without profiling run the same code as before, apart from one
+check per lake whether there is a profile to record its growth in.
+"""
+import functools
+import time
+
+import numpy as np
+
+
+#methods of FlowRaster and ArrayFlowRaster timed as stages, times include nested stages
+STAGES=("setDownnodes", "calculateLakes", "fillDepressions", "createLake", "setLakeDownnodes",
+        "addRainfall", "getFlowGrid", "extractValues", "getMaximumFlow", "getTotalRainfall", "getTotalFlow")
+#helpers ArrayFlowRaster.calculateLakes calls instead of the public methods, timed as the same stages
+HELPERS={"_growLake": "createLake", "_drainLake": "setLakeDownnodes"}
+
+
+class FlowProfile():
+    """Wall time per stage and counters of a profiled FlowRaster
+
+    Counters:
+        pitflags: pitflags off the raster edge when calculateLakes started
+        lakes: lakes created, by either engine
+        neighbourScans: calls collecting the neighbours of a cell
+        lakeNeighbours: neighbours queued by lakes growing from a pitflag (path engine)
+        lakeSteps: lowest neighbour steps of growing lakes, one per cell absorbed
+        topologyLevels: longest chain of cells draining into each other in the last 
+                        flow network, the depth the recursive flow calculation would 
+                        have reached (FlowEngine.topologicalLevels splits some of 
+                        these levels further, see longestChain)
+    """
+
+    def __init__(self):
+        """Constructor for FlowProfile, all times and counters start at zero"""
+        self._seconds={}
+        self._calls={}
+        self._counters={"pitflags": 0, "lakes": 0, "neighbourScans": 0, "lakeNeighbours": 0,
+                        "lakeSteps": 0, "topologyLevels": 0}
+        self._lakeCells=[] #cells absorbed per lake grown from a pitflag
+
+
+    def timed(self, stage, method):
+        """Returns method wrapped so its wall time is added to a stage
+
+        Input Parameter:
+            stage – name of the stage
+            method – a bound method
+        """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start=time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.addTime(stage, time.perf_counter()-start)
+        return wrapper
+
+
+    def counted(self, counter, method, size=None):
+        """Returns method wrapped so its calls are counted
+
+        Input Parameter:
+            counter – name of the counter
+            method – a bound method
+            size – optional function of the arguments, added instead of 1 per call
+        """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            self.count(counter, 1 if size is None else size(*args, **kwargs))
+            return method(*args, **kwargs)
+        return wrapper
+
+
+    def addTime(self, stage, seconds):
+        """Adds the wall time of one call of a stage"""
+        self._seconds[stage]=self._seconds.get(stage, 0.)+seconds
+        self._calls[stage]=self._calls.get(stage, 0)+1
+
+
+    def count(self, counter, number=1):
+        """Adds to a counter"""
+        self._counters[counter]=self._counters.get(counter, 0)+number
+
+
+    def setCounter(self, counter, value):
+        """Sets a counter"""
+        self._counters[counter]=value
+
+
+    def addLake(self, cells, neighbours):
+        """Records the growth of a lake from a pitflag (path engine)
+        
+        Input Parameter:
+            cells – cells the lake path absorbed, including the pitflag, before 
+                    it was cut back to the outflow
+            neighbours – neighbours queued while the lake grew
+        """
+        self.count("lakeSteps", cells-1)
+        self.count("lakeNeighbours", neighbours)
+        self._lakeCells.append(cells)
+
+
+    def getStages(self):
+        """Returns a dictionary by stage name with the total seconds and the number of calls"""
+        return {stage: {"seconds": self._seconds[stage], "calls": self._calls[stage]} for stage in self._seconds}
+
+
+    def getCounters(self):
+        """Returns a dictionary of the counters"""
+        return dict(self._counters)
+
+
+    def getLakeCells(self):
+        """Returns a list with the number of cells absorbed by each lake grown from a pitflag, in order of creation"""
+        return list(self._lakeCells)
+
+
+    def toDict(self):
+        """Returns the whole report as a dictionary, e.g. for json.dump"""
+        cells=self._lakeCells
+        return {"stages": self.getStages(),
+                "counters": self.getCounters(),
+                "lakeCells": {"count": len(cells),
+                              "total": sum(cells),
+                              "max": max(cells) if cells else 0,
+                              "mean": sum(cells)/len(cells) if cells else 0.}}
+
+
+    def __str__(self):
+        """String representation of the report, one line per stage and counter"""
+        lines=["{:<20} {:>10} {:>8}".format("stage", "seconds", "calls")]
+        for stage, values in sorted(self.getStages().items(), key=lambda item: -item[1]["seconds"]):
+            lines.append("{:<20} {:>10.4f} {:>8}".format(stage, values["seconds"], values["calls"]))
+        for counter, value in self._counters.items():
+            lines.append("{:<20} {:>10}".format(counter, value))
+        lakeCells=self.toDict()["lakeCells"]
+        lines.append("{:<20} {:>10.1f} mean, {} max".format("absorbed per lake", lakeCells["mean"], lakeCells["max"]))
+        return "\n".join(lines)
+
+
+    def __repr__(self):
+        """Representation of FlowProfile object"""
+        return self.__str__()
+
+
+def instrumentRaster(flowraster, profile):
+    """Wraps the stage methods of one FlowRaster instance
+
+    The wrappers are instance attributes shadowing the methods of the class,
+    so calls of the raster to itself go through them as well. The growth of 
+    the lakes is recorded by createLake and _growLake themselves (see FlowProfile.addLake).
+
+    Input Parameter:
+        flowraster – a FlowRaster or ArrayFlowRaster object
+        profile – a FlowProfile object
+    """
+    helpers={name: stage for name, stage in HELPERS.items() if hasattr(flowraster, name)}
+    for stage in STAGES:
+        if stage not in helpers.values(): #the public methods call the helpers, which are timed instead
+            setattr(flowraster, stage, profile.timed(stage, getattr(flowraster, stage)))
+    for name, stage in helpers.items():
+        setattr(flowraster, name, profile.timed(stage, getattr(flowraster, name)))
+    calculateLakes=flowraster.calculateLakes
+
+    @functools.wraps(calculateLakes)
+    def countLakes(*args, **kwargs):
+        pits=(flowraster._getDownnodeArray()<0)&~flowraster._edgeMask().ravel()
+        profile.count("pitflags", int(pits.sum()))
+        before=len(flowraster._lakes)
+        result=calculateLakes(*args, **kwargs)
+        profile.count("lakes", len(flowraster._lakes)-before)
+        return result
+    flowraster.calculateLakes=countLakes
+
+    for name in ("getNeighbours", "_neighbourIndices"): #ArrayFlowRaster scans with _neighbourIndices
+        if hasattr(flowraster, name):
+            setattr(flowraster, name, profile.counted("neighbourScans", getattr(flowraster, name)))
+    getTopology=flowraster._getTopology
+    counted=[None] #topology the counter was set for
+
+    @functools.wraps(getTopology)
+    def countLevels():
+        topology=getTopology()
+        if topology is not counted[0]: #a new network
+            profile.setCounter("topologyLevels", longestChain(*topology))
+            counted[0]=topology
+        return topology
+    flowraster._getTopology=countLevels
+
+
+def longestChain(downnodes, levels):
+    """Returns the number of cells of the longest chain of cells draining into each other
+    
+    This is the number of topological levels before they are split into 
+    levels without shared downnodes
+    
+    Input Parameter:
+        downnodes – int array with the flat index of each downnode, -1 for pitflags
+        levels – result of FlowEngine.topologicalLevels(downnodes)
+    """
+    depth=np.ones(downnodes.size, dtype=np.int64) #cells on the longest chain ending in each cell
+    for level in levels:
+        down=downnodes[level]
+        hasDown=down>=0
+        depth[down[hasDown]]=np.maximum(depth[down[hasDown]], depth[level[hasDown]]+1) #no shared downnodes within a level
+    return int(depth.max()) if depth.size else 0
+
+
+def uninstrument(obj):
+    """Removes all wrappers from a FlowRaster object"""
+    for name in STAGES+tuple(HELPERS)+("calculateLakes", "getNeighbours", "_neighbourIndices", "_getTopology"):
+        obj.__dict__.pop(name, None)
+
@@ -8,7 +8,7 @@ class Raster(object):
     
     '''A class to represent 2-D Rasters'''
 
-    def __init__(self,data,xorg,yorg,cellsize,nodata=-999.999):
+    def __init__(self,data,xorg,yorg,cellsize,nodata=-999.999,copy=True):
         """Constructor of a Raster, sets all the object variables
         
         Origin: xorg=0 and yorg=0 is left down corner of a cell
@@ -19,12 +19,14 @@ class Raster(object):
             yorg – An Integer describing y-origin
             cellsize – A Number describing cellsize (e.g. 1)
             nodata – No data representation
+            copy – if False an existing array (e.g. a memory map) is used without copying it
             
         """
-        self._data=np.array(data)
+        self._data=np.array(data) if copy else np.asarray(data)
         self._orgs=(xorg,yorg)
         self._cellsize=cellsize
         self._nodata=nodata
+        self._resampling=None #reduction used by resample()
         
     def getData(self):
         return self._data
@@ -55,42 +57,72 @@ class Raster(object):
         return self._nodata
     
 
-    def createWithIncreasedCellsize(self, factor):
+    def getResampling(self):
+        """Returns the reduction used to create this raster with resample(), None if it wasn't resampled"""
+        return self._resampling
+    
+
+    def createWithIncreasedCellsize(self, factor, reduction="mean"):
         """returns a new Raster with cell size larger by a factor (which must be an integer)
         
         Input Parameter:
             factor – factor of increased cellsize
+            reduction – how the cells of a block are combined, see resample()
         Returns:
             resampled Raster, a Raster object
         """
         if factor== 1: #doesnt do anything
             return self
         else:
-            return self.resample(factor)
+            return self.resample(factor, reduction)
 
 
-    def resample(self, factor):
+    def resample(self, factor, reduction="mean", offset=None):
         """Resamples the raster
         
+        The raster is cut to a multiple of factor and reshaped to 
+        (rows, factor, cols, factor), so each factor x factor block is 
+        reduced in a single array operation
+        
         Input Parameter:
             factor – factor of cellsize
+            reduction – "mean" (default), "min", "max", "sum" or "nodatamean", 
+                        the mean of the cells that are not nodata (nodata if all are)
+            offset – added to every resampled value (not to the nodata blocks of "nodatamean"), 
+                     by default 100 for both means like the original loop version and 0 for the other reductions
         
         Returns:
-            resampled Raster, a Raster object
+            resampled Raster, a Raster object, getResampling() returns the reduction
         """
         nrows=self.getRows() // factor #floor division, calcucate new number of rows
         ncols=self.getCols() // factor #floor division, calcucate new number of cols
-        newdata=np.zeros([nrows, ncols]) #create empty array
+        #blocks[i,k,j,l] is the value at row i*factor+k and column j*factor+l of the original raster
+        blocks=self._data[:nrows*factor, :ncols*factor].reshape(nrows, factor, ncols, factor)
+        
+        if reduction=="mean":
+            newdata=blocks.mean(axis=(1,3))
+        elif reduction=="min":
+            newdata=blocks.min(axis=(1,3))
+        elif reduction=="max":
+            newdata=blocks.max(axis=(1,3))
+        elif reduction=="sum":
+            newdata=blocks.sum(axis=(1,3))
+        elif reduction=="nodatamean":
+            valid=blocks!=self._nodata
+            count=valid.sum(axis=(1,3))
+            total=np.where(valid, blocks, 0).sum(axis=(1,3))
+            newdata=total/np.maximum(count, 1)
+        else:
+            raise ValueError("unknown reduction: {}".format(reduction))
         
-        for i in range(nrows): #iterate
-            for j in range(ncols): #iterate
-                sumCellValue=0.0 #set sum to zero at the start
-                for k in range(factor): #smaller box iterates through values in a (new) cell
-                    for l in range(factor):
-                        #"i*factor + k" calculates y position of data in original raster
-                        sumCellValue += self._data[i*factor + k, j*factor +l] #add new value to sum
-                newdata[i,j]=sumCellValue / factor / factor + 100 #dividing by number of cells
-        return Raster(newdata, self.getOrgs()[0],self.getOrgs()[1], self._cellsize*factor) #return new raster
+        if offset is None:
+            offset=100. if reduction in ("mean", "nodatamean") else 0.
+        newdata=newdata+offset
+        if reduction=="nodatamean":
+            newdata[count==0]=self._nodata #blocks without any data
+        resampled=Raster(newdata, self.getOrgs()[0],self.getOrgs()[1], self._cellsize*factor, self._nodata) #return new raster
+        resampled._resampling=reduction
+        return resampled
     
     
 
@@ -4,24 +4,137 @@ Created on Thu Jan 31 01:00:00 2013
 
 @author: nrjh
 """
+import gzip
+import itertools
+import json
+import os
+import time
+
 import numpy as np
 from Raster import Raster
-import random
 import math
 
-def readRaster(fileName):
+def readRaster(fileName, dtype=float, verbose=False, cache=False):
     """Generates a raster object from a ARC-INFO ascii format file
     
-    """
+    The header is read line by line, the data body is then decoded in bulk 
+    straight into a numpy array. Files ending with .gz are read with gzip.
+    
+    With cache=True a binary sidecar is written next to the file the first 
+    time it is read: fileName.npy with the data and fileName.npy.json with 
+    the header and the size and mtime of the source file. Later reads 
+    memory-map the sidecar instead of parsing the text, so the raster data 
+    is shared through the page cache. The data of a cached raster is 
+    read-only, also on the first read, so code that changes it fails right 
+    away. The sidecar is rewritten when the source file changes; if it 
+    cannot be written the file is just parsed.
     
-    lines = []
-    myFile=open(fileName,'r')
+    Input Parameter:
+        fileName – path of the ascii grid file
+        dtype – numpy dtype of the raster data, float by default
+        verbose – if True, prints the number of cells read and the parse throughput
+        cache – if True, the binary sidecar is used and written, False by default
+    
+    """
+    if cache:
+        raster=_readSidecar(fileName, dtype)
+        if raster is not None:
+            if verbose:
+                print ("Memory-mapped {} cells from the sidecar of {}".format(raster.getData().size, fileName))
+            return raster
         
+    raster=_parseRaster(fileName, dtype, verbose)
+    if cache and raster is not None:
+        _writeSidecar(fileName, raster)
+        raster.getData().flags.writeable=False #like the memory-mapped sidecar on later reads
+    return raster
+
+
+def writeRaster(fileName, raster, fmt="%.10g"):
+    """Writes a raster to an ARC-INFO ascii format file
+    
+    Files ending with .gz are compressed with gzip. A binary sidecar of an 
+    older file with the same name is rewritten by the next readRaster, as the 
+    size and mtime of the file change.
+    
+    Input Parameter:
+        fileName – path of the ascii grid file
+        raster – a Raster object
+        fmt – number format of the cell values
+    """
+    header="ncols {}\nnrows {}\nxllcorner {}\nyllcorner {}\ncellsize {}\nNODATA_value {}".format(
+            raster.getCols(), raster.getRows(), raster.getOrgs()[0], raster.getOrgs()[1], raster.getCellsize(), raster.getNoData())
+    np.savetxt(fileName, raster.getData(), fmt=fmt, header=header, comments='')
+
+
+def mapRaster(fileName, dtype=float, chunkRows=256):
+    """Returns a Raster backed by the memory-mapped binary sidecar of a file
+    
+    If there is no valid sidecar (see readRaster) it is written first by 
+    streaming the ascii file chunkRows lines at a time straight into the 
+    sidecar, so the grid never has to fit into memory. Slices of the 
+    returned data are read from disk on demand.
+    
+    Input Parameter:
+        fileName – path of the ascii grid file
+        dtype – numpy dtype of the raster data, float by default
+        chunkRows – number of lines decoded at once
+    
+    Returns:
+        a Raster object with read-only memory-mapped data
+    """
+    raster=_readSidecar(fileName, dtype)
+    if raster is not None:
+        return raster
+    
+    dataPath,headerPath=_sidecarPaths(fileName)
+    suffix=_temporarySuffix()
+    try:
+        with _openRaster(fileName) as myFile:
+            header,line=_readHeader(myFile)
+            if header is None:
+                print ("Row or Column size not specified for Raster file read")
+                return None
+            data=np.lib.format.open_memmap(dataPath+suffix, mode='w+', dtype=dtype, shape=(header['nrows'], header['ncols']))
+            flat=data.reshape(-1)
+            written=0
+            lines=[line] #the last header line read is already the first data row
+            while lines:
+                values=np.fromstring(''.join(lines), dtype=dtype, sep=' ')
+                if written+values.size>flat.size:
+                    raise ValueError("{} holds more than {} rows x {} cols".format(fileName, header['nrows'], header['ncols']))
+                flat[written:written+values.size]=values
+                written+=values.size
+                lines=list(itertools.islice(myFile, chunkRows))
+            if written!=flat.size:
+                raise ValueError("{} holds {} values, expected {} rows x {} cols".format(fileName, written, header['nrows'], header['ncols']))
+            data.flush()
+            del data, flat
+        _commitSidecar(fileName, (header['xll'], header['yll']), header['cellsize'], header['nodata'], suffix)
+    except Exception:
+        _removeTemporary(fileName, suffix)
+        raise
+    return _readSidecar(fileName, dtype)
+
+
+def _openRaster(fileName):
+    """Opens a raster file for reading text, through gzip if it ends with .gz"""
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName,'rt')
+    return open(fileName,'r')
+
+
+def _readHeader(myFile):
+    """Reads the header of an ARC-INFO ascii format file
+    
+    Returns:
+        a tuple (header, line)
+            header: a dictionary with ncols, nrows, xll, yll, cellsize and nodata, 
+                    None if the number of rows or cols is missing
+            line: the first data line, which is read to find the end of the header
+    """
     end_header=False
-    xll=0.
-    yll=0.
-    nodata=-999.999
-    cellsize=1.0
+    header={'xll': 0., 'yll': 0., 'nodata': -999.999, 'cellsize': 1.0, 'nrows': None, 'ncols': None}
     
     while (not end_header):
         line=myFile.readline()    
@@ -29,78 +142,138 @@ def readRaster(fileName):
         keyword=items[0].lower()
         value=items[1]
         if (keyword=='ncols'):
-            ncols=int(value)
+            header['ncols']=int(value)
         elif (keyword=='nrows'):
-            nrows=int(value)
+            header['nrows']=int(value)
         elif (keyword=='xllcorner'):
-            xll=float(value)
+            header['xll']=float(value)
         elif (keyword=='yllcorner'):
-            yll=float(value)  
+            header['yll']=float(value)  
         elif (keyword=='nodata_value'):
-            nodata=float(value)
+            header['nodata']=float(value)
         elif (keyword=='cellsize'):
-            cellsize=float(value)  
+            header['cellsize']=float(value)  
         else:
             end_header=True
+    
+    if (header['nrows']==None or header['ncols']==None):
+        return None, line
+    return header, line
 
-    if (nrows==None or ncols==None):
-        print ("Row or Column size not specified for Raster file read")
-        return None  
 
-    items=line.split()
-        
-    datarows=[]
-    items=line.split()
-    row=[]
-    for item in items:
-        row.append(float(item))
- 
-    datarows.append(row)
+def _parseRaster(fileName, dtype, verbose):
+    """Parses an ARC-INFO ascii format file, see readRaster"""
+    start=time.perf_counter()
+    with _openRaster(fileName) as myFile:
+        header,line=_readHeader(myFile)
+        if header is None:
+            print ("Row or Column size not specified for Raster file read")
+            return None  
+    
+        #the last line read is already the first data row
+        body=line+myFile.read()
         
-    for line in myFile.readlines():
-        lines.append(line)
-        items=line.split()
-        row=[]
-        for item in items:
-            row.append(float(item))
-   
-        datarows.append(row)
+    nrows,ncols=header['nrows'],header['ncols']
+    data=np.fromstring(body, dtype=dtype, sep=' ') #sep=' ' matches any whitespace, including newlines
+    if data.size!=nrows*ncols:
+        raise ValueError("{} holds {} values, expected {} rows x {} cols".format(fileName, data.size, nrows, ncols))
+    data.shape=(nrows, ncols)
+    
+    if verbose:
+        seconds=time.perf_counter()-start
+        print ("Read {} cells from {} in {:.3f} s ({:.0f} cells/s, {:.1f} MB/s)".format(
+                data.size, fileName, seconds, data.size/seconds, len(body)/seconds/1e6))
+    
+    return Raster(data,header['xll'],header['yll'],header['cellsize'],header['nodata'])
+    
+    
+def _sidecarPaths(fileName):
+    """Returns the paths (data, header) of the binary sidecar of a raster file"""
+    return fileName+'.npy', fileName+'.npy.json'
 
-    data=np.array(datarows)
+
+def _readSidecar(fileName, dtype):
+    """Memory-maps the binary sidecar of a raster file
     
-    return Raster(data,xll,yll,cellsize,nodata)
+    Returns:
+        a Raster backed by the memory-mapped data, None if there is no 
+        sidecar or it doesn't match the source file (size, mtime or dtype)
+    """
+    dataPath,headerPath=_sidecarPaths(fileName)
+    try:
+        source=os.stat(fileName)
+        with open(headerPath,'r') as headerFile:
+            header=json.load(headerFile)
+        if header['size']!=source.st_size or header['mtime_ns']!=source.st_mtime_ns:
+            return None
+        data=np.load(dataPath, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    if data.dtype!=np.dtype(dtype):
+        return None
+    return Raster(data,header['xll'],header['yll'],header['cellsize'],header['nodata'],copy=False)
+
+
+def _writeSidecar(fileName, raster):
+    """Writes the binary sidecar of a raster file, see readRaster"""
+    dataPath,headerPath=_sidecarPaths(fileName)
+    suffix=_temporarySuffix()
+    try:
+        with open(dataPath+suffix,'wb') as dataFile:
+            np.save(dataFile, raster.getData())
+        _commitSidecar(fileName, raster.getOrgs(), raster.getCellsize(), raster.getNoData(), suffix)
+    except OSError:
+        _removeTemporary(fileName, suffix)
+
+
+def _temporarySuffix():
+    """Returns the suffix of sidecar files while they are written"""
+    return '.{}.tmp'.format(os.getpid())
+
+
+def _commitSidecar(fileName, orgs, cellsize, nodata, suffix):
+    """Writes the header of a sidecar whose data was written to the temporary 
+    data path, then renames both files
     
+    Both files are written under a temporary name first, so other processes 
+    never map a half written sidecar
+    """
+    dataPath,headerPath=_sidecarPaths(fileName)
+    source=os.stat(fileName)
+    header={'xll': orgs[0], 'yll': orgs[1], 'cellsize': cellsize, 'nodata': nodata, 
+            'size': source.st_size, 'mtime_ns': source.st_mtime_ns}
+    with open(headerPath+suffix,'w') as headerFile:
+        json.dump(header, headerFile)
+    os.replace(dataPath+suffix, dataPath)
+    os.replace(headerPath+suffix, headerPath)
+
+
+def _removeTemporary(fileName, suffix):
+    """Removes the temporary files of a sidecar that could not be written"""
+    for path in _sidecarPaths(fileName):
+        if os.path.exists(path+suffix):
+            os.remove(path+suffix)
     
-def createRanRaster(rows=20,cols=30,cellsize=1,xorg=0,yorg=0,nodata=-999.999,levels=5,datahi=100.,datalo=0.):
-   """Creates a random raster"""
+    
+def createRanRaster(rows=20,cols=30,cellsize=1,xorg=0,yorg=0,nodata=-999.999,levels=5,datahi=100.,datalo=0.,seed=None):
+   """Creates a random raster
+   
+   Each level is uniform noise smoothed with a wrap-around window of 2i+1 
+   cells and weighted with 2**i. Like the original loop version the window 
+   runs along the rows only; the window sums are taken from cumulative sums, 
+   so a level costs O(rows*cols) whatever its window size.
+   
+   Input Parameter:
+       seed – seed (or numpy.random.Generator) for the noise, the same seed gives the same raster
+   """
    levels=min(levels,rows)
    levels=min(levels,cols)
-   data=np.zeros([levels,rows,cols])  
+   rng=np.random.default_rng(seed)
+   data=rng.uniform(datalo,datahi,size=(levels,rows,cols))
    dataout=np.zeros([rows,cols]) 
    
-   for x in np.nditer(data,op_flags=['readwrite']):
-       x[...]=random.uniform(datalo,datahi) 
-
-   
-
-   
    for i in range(levels):
-       lin=((i)*2)+1
-       lin2=lin*lin
-       iterator=np.zeros([lin2,2], dtype=int)
-       for itx in range(lin):
-           for ity in range(lin):
-               iterator[itx*lin+ity,0]=(itx-i)
-       
-       part=data[i]
-      
-       new=np.zeros([rows,cols])
-       for j in range(rows):
-           for k in range(cols):
-                for it in range(lin2):
-                        r=(j+iterator[it,0])%rows
-                        c=(k+iterator[it,1])%cols
-                        new[j,k]=new[j,k]+part[r,c]
+       new=_wrapWindowSum(data[i],2*i+1)
         
        minval=np.min(new)
        maxval=np.max(new)
@@ -115,42 +288,72 @@ def createRanRaster(rows=20,cols=30,cellsize=1,xorg=0,yorg=0,nodata=-999.999,lev
    datarange=datahi-datalo
    dataout=(((dataout-minval)/ran)*(datarange))+datalo
    return Raster(dataout,xorg,yorg,cellsize,nodata)
+
+
+def _wrapWindowSum(part, length):
+   """Sums a wrap-around window along the rows of a 2d array
+   
+   Row j of the result is the sum of the rows j-length//2 ... j+length//2 
+   of part (modulo the number of rows). Windows longer than the array count 
+   whole periods once per period, the rest is read from cumulative sums.
+   """
+   rows=part.shape[0]
+   periods,rest=divmod(length,rows)
+   cumsum=np.zeros((2*rows+1,)+part.shape[1:])
+   np.cumsum(np.concatenate((part,part)),axis=0,out=cumsum[1:])
+   start=(np.arange(rows)-length//2)%rows #first row of each window
+   return periods*cumsum[rows]+cumsum[start+rest]-cumsum[start]
    
 
-def createRanRasterSlope(rows=20,cols=30,cellsize=1,xorg=0,yorg=0,nodata=-999.999,levels=5,datahi=100.,datalo=0.,focusx=None,focusy=None,ranpart=0.5):
+def createRanRasterSlope(rows=20,cols=30,cellsize=1,xorg=0,yorg=0,nodata=-999.999,levels=5,datahi=100.,datalo=0.,focusx=None,focusy=None,ranpart=0.5,seed=None):
     """Generates a Random Slope Raster
+    
+    Input Parameter:
+        seed – seed of the random part, see createRanRaster
     """
-    if (focusx==None):
+    data_out=createRanRasterSlopeStack(rows,cols,levels,datahi,datalo,focusx,focusy,ranpart,seed)[0]
+    return Raster(data_out,xorg,yorg,cellsize)
+
+
+def createRanRasterSlopeStack(rows=20,cols=30,levels=5,datahi=100.,datalo=0.,focusx=None,focusy=None,ranpart=0.5,seed=None):
+    """Generates several Random Slope Rasters in one call
+    
+    The slope falls away from a focus point. focusx, focusy and ranpart can 
+    each be a number or a sequence, they are broadcast against each other 
+    and every combination gives one raster. The distance fields of all 
+    rasters are calculated at once from broadcast coordinate grids.
+    
+    Input Parameter:
+        focusx, focusy – column and row of the focus point(s), the centre if None
+        ranpart – share(s) of the random part, between 0 and 1
+        seed – seed of the random parts, see createRanRaster; every raster 
+               gets its own random part drawn from the same generator
+        
+    Returns:
+        data_out – numpy array of shape (k, rows, cols)
+    """
+    if (focusx is None):
         focusx=cols/2
-    if (focusy==None):
+    if (focusy is None):
         focusy=rows/2
-        
-    rast=createRanRaster(rows,cols,cellsize,xorg,yorg,nodata,levels,1.,0.)
+    focusx,focusy,ranpart=np.broadcast_arrays(np.atleast_1d(focusx),np.atleast_1d(focusy),np.atleast_1d(ranpart))
+    focusx,focusy,ranpart=(a.astype(float).ravel()[:,np.newaxis,np.newaxis] for a in (focusx,focusy,ranpart))
+    
+    rng=np.random.default_rng(seed)
+    ran_data=np.array([createRanRaster(rows,cols,1,0,0,-999.999,levels,1.,0.,rng).getData() for k in range(ranpart.shape[0])])
 
-    slope_data=np.zeros([rows,cols])
     maxdist=math.sqrt(rows*rows+cols*cols)
-    
-    for i in range(rows):
-        for j in range(cols):
-            xd=focusx-j
-            yd=focusy-i
-            dist=maxdist-math.sqrt((xd*xd)+(yd*yd))
-            slope_data[i,j]=dist/maxdist
+    i,j=np.ogrid[:rows,:cols]
+    slope_data=(maxdist-np.hypot(focusx-j,focusy-i))/maxdist
             
-    minval=np.min(slope_data)
-    maxval=np.max(slope_data)
-    ran=maxval-minval
-   
-    slope_data=((slope_data-minval)/ran)
-    
-    ran_data=rast.getData()
+    slope_data=_normalise(slope_data)
     
     data_out=slope_data*(1.-ranpart)+ran_data*(ranpart)
-    minval=np.min(data_out)
-    maxval=np.max(data_out)
-    ran=maxval-minval
-    datarange=datahi-datalo
-    data_out=(((data_out-minval)/ran)*datarange)+datalo
-        
-    return Raster(data_out,xorg,yorg,cellsize)
-    
\ No newline at end of file
+    return _normalise(data_out)*(datahi-datalo)+datalo
+
+
+def _normalise(stack):
+    """Scales each raster of a (k, rows, cols) stack to the range 0..1"""
+    minval=stack.min(axis=(1,2),keepdims=True)
+    maxval=stack.max(axis=(1,2),keepdims=True)
+    return (stack-minval)/(maxval-minval)
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled, out-of-core flow calculation for DEMs larger than memory
+
+The DEM is memory-mapped from its binary sidecar and processed in square
+tiles. Everything that crosses a tile border is resolved on small graphs
+of the tile perimeter cells, so the memory needed depends on the tile
+size and not on the size of the raster.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from RasterHandler import mapRaster
+from FlowEngine import d8Downnodes, accumulateFlow, priorityFlood, solveSpillGraph, drainFlats
+
+
+class TiledFlowRaster():
+    """A flow raster that is processed tile by tile
+
+    Works like ArrayFlowRaster with the priority flood lake engine, but
+    the cells are never all in memory at once. The DEM is read through
+    RasterHandler.mapRaster and the results are written tile by tile to
+    memory-mapped .npy files in a work directory:
+        downnode.npy – flat index of the downnode of each cell, -1 for pitflags
+        filled.npy, lakedepth.npy – filled elevation and lake depth (calculateLakes)
+        flow.npy – accumulated flow of each cell (calculateFlow)
+    The other files in the work directory are intermediate results.
+
+    """
+
+    def __init__(self, fileName, tileSize=512, workDir=None):
+        """Constructor for TiledFlowRaster, calculates the D8 downnodes
+
+        Input Parameter:
+            fileName – path of the ascii grid file of the DEM
+            tileSize – number of rows and cols of a tile
+            workDir – directory for the result files, a new temporary directory if None
+
+        """
+        self._raster=mapRaster(fileName)
+        self._elevation=self._raster.getData()
+        self._tileSize=tileSize
+        if workDir is None:
+            workDir=tempfile.mkdtemp(prefix="tiledflow")
+        os.makedirs(workDir, exist_ok=True)
+        self._workDir=workDir
+        self._rainfall=None #set with addRainfall()
+        self._lakedepth=None #set with calculateLakes()
+        self._flow=None #set with calculateFlow()
+        self._downnode=self._createArray("downnode", np.int64)
+        self.setDownnodes()
+
+
+    def getShape(self):
+        """return the shape of the raster"""
+        return self._elevation.shape
+
+    def getRows(self):
+        return self._elevation.shape[0]
+
+    def getCols(self):
+        return self._elevation.shape[1]
+
+    def getOrgs(self):
+        return self._raster.getOrgs()
+
+    def getCellsize(self):
+        return self._raster.getCellsize()
+
+    def getWorkDir(self):
+        return self._workDir
+
+
+    def getTiles(self):
+        """Returns the tiles of the raster
+
+        Returns:
+            a list of (r0, r1, c0, c1) tuples, the tile covers the rows r0 to r1-1
+            and the cols c0 to c1-1
+        """
+        tiles=[]
+        for r0 in range(0, self.getRows(), self._tileSize):
+            for c0 in range(0, self.getCols(), self._tileSize):
+                tiles.append((r0, min(r0+self._tileSize, self.getRows()), c0, min(c0+self._tileSize, self.getCols())))
+        return tiles
+
+
+    def getDownnodes(self):
+        """Returns the memory-mapped downnode grid, flat index of the downnode, -1 for pitflags"""
+        return self._downnode
+
+
+    def getLakeDepth(self):
+        """Returns the memory-mapped lake depth grid, None before calculateLakes()"""
+        return self._lakedepth
+
+
+    def getFlow(self):
+        """Returns the memory-mapped flow grid of the last calculateFlow(), None before"""
+        return self._flow
+
+
+    def setDownnodes(self):
+        """Calculates the D8 downnodes tile by tile
+
+        Each tile is read with a one cell halo, so the cells on the tile
+        border see all their neighbours
+        """
+        for r0,r1,c0,c1 in self.getTiles():
+            window=self._readWindow(self._elevation, r0, r1, c0, c1)
+            downnodes,pitflags=d8Downnodes(window)
+            self._downnode[r0:r1,c0:c1]=self._windowToGlobal(downnodes[1:-1,1:-1], r0-1, c0-1, c1-c0+2)
+        self._downnode.flush()
+        self._flow=None
+
+
+    def calculateLakes(self):
+        """Fills all depressions and drains the lakes towards their outflow
+
+        1. Each tile is filled with priorityFlood as if its perimeter
+           drained freely. Every perimeter cell starts a watershed label.
+        2. The labels, with the spill edges within and across tiles and the
+           edge pitflags as outlets, form a small graph. solveSpillGraph
+           finds the level each label spills at and where it drains to.
+        3. The filled elevation of a cell is the higher of its tile fill and
+           the spill level of its label, which is the same surface a priority
+           flood over the whole raster gives.
+        4. Cells with a lower neighbour on the filled surface drain with D8.
+           Flat cells above the spill level of their label drain to their
+           flood parent, flat cells at the spill level drain through their
+           label to its exit (drainFlats) and on to the next label.
+
+        The filled elevation and lake depth are written to filled.npy and lakedepth.npy
+        """
+        tileFilled=self._createArray("tilefilled", float)
+        labels=self._createArray("labels", np.int64)
+        parents=self._createArray("parents", np.int64)
+        edges=[]
+        outlets=[]
+        edgeCells=[]
+
+        for r0,r1,c0,c1 in self.getTiles(): #step 1
+            elevation=np.array(self._elevation[r0:r1,c0:c1], dtype=float)
+            filled,tileParents,tileLabels,(a,b,weight,cellA,cellB)=priorityFlood(elevation, labels=True) #outlets default to the tile perimeter
+            tileFilled[r0:r1,c0:c1]=filled
+            labels[r0:r1,c0:c1]=self._windowToGlobal(tileLabels, r0, c0, c1-c0)
+            parents[r0:r1,c0:c1]=self._windowToGlobal(tileParents, r0, c0, c1-c0)
+            edges.append((self._windowToGlobal(a, r0, c0, c1-c0), self._windowToGlobal(b, r0, c0, c1-c0), weight,
+                          self._windowToGlobal(cellA, r0, c0, c1-c0), self._windowToGlobal(cellB, r0, c0, c1-c0)))
+            edges.extend(self._crossTileEdges(r0, r1, c0, c1))
+
+            edge=self._edgeMask(r0, r1, c0, c1)
+            cells=self._windowToGlobal(np.flatnonzero(edge), r0, c0, c1-c0)
+            edgeCells.append((cells, elevation[edge]))
+            outlets.append((self._downnode[r0:r1,c0:c1]<0)[edge]) #edge pitflags
+
+        outletMask=np.concatenate(outlets)
+        edgeCells,edgeLevels=(np.concatenate(x) for x in zip(*edgeCells))
+        if not outletMask.any(): #like priorityFlood, all edge cells drain if there is no edge pitflag
+            outletMask[:]=True
+        self._outlets=edgeCells[outletMask]
+        a,b,weight,cellA,cellB=(np.concatenate(x) for x in zip(*edges))
+        labelIds,spill,exitFrom,exitTo=solveSpillGraph(a, b, weight, cellA, cellB, self._outlets, edgeLevels[outletMask]) #step 2
+
+        filledSurface=self._createArray("filled", float)
+        self._lakedepth=self._createArray("lakedepth", float)
+        for r0,r1,c0,c1 in self.getTiles(): #step 3
+            tileSpill=spill[np.searchsorted(labelIds, labels[r0:r1,c0:c1])]
+            filled=np.maximum(tileFilled[r0:r1,c0:c1], tileSpill)
+            filledSurface[r0:r1,c0:c1]=filled
+            self._lakedepth[r0:r1,c0:c1]=filled-self._elevation[r0:r1,c0:c1]
+        filledSurface.flush()
+        self._lakedepth.flush()
+
+        for r0,r1,c0,c1 in self.getTiles(): #step 4
+            window=self._readWindow(filledSurface, r0, r1, c0, c1)
+            downnodes,pitflags=d8Downnodes(window)
+            downnodes=self._windowToGlobal(downnodes[1:-1,1:-1], r0-1, c0-1, c1-c0+2)
+            pitflags=pitflags[1:-1,1:-1]
+            filled=window[1:-1,1:-1]
+            tileLabels=np.array(labels[r0:r1,c0:c1])
+            label=np.searchsorted(labelIds, tileLabels)
+            cells=self._windowToGlobal(np.arange(filled.size).reshape(filled.shape), r0, c0, c1-c0)
+
+            flat=pitflags & ~np.isin(cells, self._outlets)
+            high=flat & (filled>spill[label])
+            downnodes[high]=parents[r0:r1,c0:c1][high]
+            isExit=flat & (cells==exitFrom[label])
+            downnodes[isExit]=exitTo[label][isExit]
+            atSpill=flat & ~high & ~isExit
+            drained,down=drainFlats(tileLabels, (filled==spill[label]) & ~atSpill, atSpill)
+            assert drained.size==np.count_nonzero(atSpill) #every flat cell drains
+            downnodes.flat[drained]=cells.flat[down]
+            self._downnode[r0:r1,c0:c1]=downnodes
+        self._downnode.flush()
+        self._flow=None
+
+
+    def addRainfall(self, rainfall):
+        """Adds rainfall to the raster
+
+        Input Parameter:
+            rainfall – path of an ascii grid file (memory-mapped like the DEM)
+                       or an array (e.g. a memmap) with the shape of the raster
+        """
+        if isinstance(rainfall, str):
+            rainfall=mapRaster(rainfall).getData()
+        assert rainfall.shape==self.getShape() #assert that same shape
+        self._rainfall=rainfall
+        self._flow=None
+
+
+    def calculateFlow(self, constRain=None):
+        """Accumulates the flow of every cell tile by tile
+
+        1. Each tile accumulates its own rain. Cells draining out of the tile
+           are its exits, and every perimeter cell is linked to the exit (if
+           any) its water leaves the tile through.
+        2. The perimeter cells form a small flow network: exits drain to a
+           cell of the next tile, other perimeter cells to their exit. Its
+           accumulated flow gives the flow entering each tile from outside.
+        3. Each tile accumulates its rain plus the flow entering it.
+
+        Input Parameter:
+            constRain – constant rain per cell in mm, if left out the added rainfall is used (0 if there is none)
+
+        Returns:
+            flow – memory-mapped array with the flow of each cell, also written to flow.npy
+        """
+        perimeters=[]
+        links=[]
+        exits=[]
+        for r0,r1,c0,c1 in self.getTiles(): #step 1
+            tileDown,isExit=self._tileDownnodes(r0, r1, c0, c1)
+            flow=accumulateFlow(tileDown, self._tileRain(r0, r1, c0, c1, constRain))
+
+            terminal=np.arange(tileDown.size) #pointer jumping to the end of each path within the tile
+            terminal[tileDown>=0]=tileDown[tileDown>=0]
+            while np.any(terminal[terminal]!=terminal):
+                terminal=terminal[terminal]
+            perimeter=np.flatnonzero(self._perimeterMask(r1-r0, c1-c0))
+            link=np.where(isExit[terminal[perimeter]], terminal[perimeter], -1)
+
+            perimeters.append(self._windowToGlobal(perimeter, r0, c0, c1-c0))
+            links.append(self._windowToGlobal(link, r0, c0, c1-c0))
+            exitCells=np.flatnonzero(isExit)
+            exits.append((self._windowToGlobal(exitCells, r0, c0, c1-c0), flow.flat[exitCells]))
+
+        perimeters=np.concatenate(perimeters) #step 2
+        order=np.argsort(perimeters)
+        perimeters=perimeters[order]
+        links=np.concatenate(links)[order]
+        exitCells,exitFlow=(np.concatenate(x) for x in zip(*exits))
+        exitIndex=np.searchsorted(perimeters, exitCells)
+
+        nextCell=np.where(links>=0, np.searchsorted(perimeters, links), -1)
+        nextCell[exitIndex]=np.searchsorted(perimeters, self._downnode.reshape(-1)[exitCells])
+        weights=np.zeros(perimeters.size)
+        weights[exitIndex]=exitFlow
+        boundaryFlow=accumulateFlow(nextCell, weights)
+        inflow=np.zeros(perimeters.size)
+        np.add.at(inflow, nextCell[exitIndex], boundaryFlow[exitIndex])
+
+        self._flow=self._createArray("flow", float)
+        for r0,r1,c0,c1 in self.getTiles(): #step 3
+            tileDown,isExit=self._tileDownnodes(r0, r1, c0, c1)
+            rain=np.array(self._tileRain(r0, r1, c0, c1, constRain), dtype=float)
+            perimeter=self._perimeterMask(r1-r0, c1-c0)
+            cells=self._windowToGlobal(np.flatnonzero(perimeter), r0, c0, c1-c0)
+            rain[perimeter.ravel()]+=inflow[np.searchsorted(perimeters, cells)]
+            self._flow[r0:r1,c0:c1]=accumulateFlow(tileDown, rain).reshape(r1-r0, c1-c0)
+        self._flow.flush()
+        return self._flow
+
+
+    def getTotalRainfall(self, constRain=None):
+        """Calculates the total rainfall over all cells, tile by tile"""
+        return sum(float(np.sum(self._tileRain(r0, r1, c0, c1, constRain))) for r0,r1,c0,c1 in self.getTiles())
+
+
+    def getTotalFlow(self):
+        """Calculates the total flow leaving the raster at edge pitflags, from the last calculateFlow()"""
+        total=0.
+        for r0,r1,c0,c1 in self.getTiles():
+            outlet=self._edgeMask(r0, r1, c0, c1) & (self._downnode[r0:r1,c0:c1]<0)
+            total+=float(np.sum(self._flow[r0:r1,c0:c1][outlet]))
+        return total
+
+
+    def getMaximumFlow(self):
+        """Calculates the maximum flow of the last calculateFlow(), tile by tile
+
+        Returns:
+            a tuple – (maxrate, (row, col))
+        """
+        maxrate=None
+        maxcell=None
+        for r0,r1,c0,c1 in self.getTiles():
+            flow=self._flow[r0:r1,c0:c1]
+            index=int(np.argmax(flow))
+            if maxrate is None or flow.flat[index]>maxrate:
+                maxrate=float(flow.flat[index])
+                maxcell=(r0+index//(c1-c0), c0+index%(c1-c0))
+        return (maxrate, maxcell)
+
+
+    def _createArray(self, name, dtype):
+        """Creates a memory-mapped array with the shape of the raster in the work directory"""
+        return np.lib.format.open_memmap(os.path.join(self._workDir, name+".npy"), mode="w+", dtype=dtype, shape=self.getShape())
+
+
+    def _readWindow(self, array, r0, r1, c0, c1):
+        """Reads a tile of a (memory-mapped) array with a one cell halo, +inf outside the raster"""
+        window=np.full((r1-r0+2, c1-c0+2), np.inf)
+        rr0,rr1=max(r0-1, 0), min(r1+1, self.getRows())
+        cc0,cc1=max(c0-1, 0), min(c1+1, self.getCols())
+        window[rr0-r0+1:rr1-r0+1, cc0-c0+1:cc1-c0+1]=array[rr0:rr1, cc0:cc1]
+        return window
+
+
+    def _windowToGlobal(self, index, r0, c0, width):
+        """Converts flat indices within a window starting at (r0, c0) to flat indices of the raster, -1 stays -1"""
+        index=np.asarray(index, dtype=np.int64)
+        return np.where(index>=0, (r0+index//width)*self.getCols()+c0+index%width, -1)
+
+
+    def _edgeMask(self, r0, r1, c0, c1):
+        """Returns a 2d bool array for a tile which is True for the cells on the raster edge"""
+        edge=np.zeros((r1-r0, c1-c0), dtype=bool)
+        edge[0,:]|=(r0==0)
+        edge[-1,:]|=(r1==self.getRows())
+        edge[:,0]|=(c0==0)
+        edge[:,-1]|=(c1==self.getCols())
+        return edge
+
+
+    def _perimeterMask(self, rows, cols):
+        """Returns a 2d bool array which is True for the cells on the perimeter of a tile"""
+        perimeter=np.ones((rows, cols), dtype=bool)
+        perimeter[1:-1,1:-1]=False
+        return perimeter
+
+
+    def _crossTileEdges(self, r0, r1, c0, c1):
+        """Returns the spill edges between the perimeter cells of a tile and
+        those of the tiles below and to the right of it
+
+        Perimeter cells are their own label, an edge weighs the higher
+        elevation of its two cells
+        """
+        edges=[]
+        if r1<self.getRows(): #the row below the tile, one col wider on each side for diagonals
+            upper=np.arange(c0, c1)
+            for dc in (-1, 0, 1):
+                lower=upper+dc
+                valid=(lower>=0) & (lower<self.getCols())
+                edges.append(((r1-1)*self.getCols()+upper[valid], r1*self.getCols()+lower[valid]))
+        if c1<self.getCols(): #the col right of the tile, one row wider on each side for diagonals
+            left=np.arange(r0, r1)
+            for dr in (-1, 0, 1):
+                right=left+dr
+                valid=(right>=0) & (right<self.getRows())
+                edges.append((left[valid]*self.getCols()+c1-1, right[valid]*self.getCols()+c1))
+        result=[]
+        flat=self._elevation.reshape(-1)
+        for a,b in edges:
+            weight=np.maximum(flat[a], flat[b]).astype(float)
+            result.append((a, b, weight, a, b))
+        return result
+
+
+    def _tileDownnodes(self, r0, r1, c0, c1):
+        """Returns the downnodes of a tile as flat indices within the tile
+
+        Returns:
+            a tuple (downnodes, exits)
+                downnodes: flat int array, -1 for pitflags and for cells draining out of the tile
+                exits: flat bool array, True for cells draining out of the tile
+        """
+        down=np.array(self._downnode[r0:r1,c0:c1]).ravel()
+        r,c=np.divmod(down, self.getCols())
+        inside=(down>=0) & (r>=r0) & (r<r1) & (c>=c0) & (c<c1)
+        tileDown=np.where(inside, (r-r0)*(c1-c0)+(c-c0), -1)
+        return tileDown, (down>=0) & ~inside
+
+
+    def _tileRain(self, r0, r1, c0, c1, constRain=None):
+        """Returns the rain per cell of a tile as a flat array"""
+        if constRain is not None:
+            return np.full((r1-r0)*(c1-c0), constRain, dtype=float)
+        if self._rainfall is None:
+            return np.zeros((r1-r0)*(c1-c0))
+        return np.array(self._rainfall[r0:r1,c0:c1], dtype=float).ravel()